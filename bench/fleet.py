@@ -0,0 +1,356 @@
+"""Load test for the broker and Kubios gateway: many simulated Picos publishing at once.
+
+    python -m bench.fleet --host 192.168.9.253 --port 21883 --devices 500 --seconds 120
+    python -m bench.fleet --devices 2000 --ramp 30 --hr-interval 30 --kubios-interval 60 --json fleet.json
+
+Every device connects with its own unique_id-style client id like PicoConnection, subscribes to
+kubios-response, publishes hr-data records shaped like HRVAnalysis.record and sends RRI requests like
+KubiosMenu.send_to_kubios (JSON, or the compact rri-delta-v1 format with --compact, which needs the
+gateway.rri_shim). Responses are matched to requests by id. Every few seconds and at the end it reports
+connected devices, publish rate, request/response latency percentiles and error counts.
+
+Devices speak just enough MQTT 3.1.1 (QoS 0) over asyncio streams, so thousands fit in one process."""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+
+from sim.traces import synthetic_ibi
+from src.components.rri_codec import encode_rri, FORMAT as RRI_FORMAT
+
+KEEPALIVE = 60  # s, as PicoConnection
+HR_TOPIC = "hr-data"
+REQUEST_TOPIC = "kubios-request"
+RESPONSE_TOPIC = "kubios-response"
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def mqtt_string(s):
+    s = s.encode() if isinstance(s, str) else s
+    return struct.pack("!H", len(s)) + s
+
+
+def packet(kind, body=b""):
+    return bytes([kind]) + encode_length(len(body)) + body
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class MQTTConnection:
+    """One device's MQTT session. on_message(topic, payload) is called from read_loop()."""
+    def __init__(self, client_id, on_message):
+        self.client_id = client_id
+        self.on_message = on_message
+        self.reader = None
+        self.writer = None
+        self.packet_id = 0
+
+    async def read_packet(self):
+        kind = (await self.reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        return kind, await self.reader.readexactly(length)
+
+    async def connect(self, host, port, timeout):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        body = mqtt_string("MQTT") + bytes([4, 0x02]) + struct.pack("!H", KEEPALIVE) + mqtt_string(self.client_id)
+        self.writer.write(packet(CONNECT, body))
+        kind, body = await asyncio.wait_for(self.read_packet(), timeout)
+        if kind != CONNACK or body[1] != 0:
+            raise ConnectionError(f"connection refused ({body[1] if len(body) > 1 else kind})")
+
+    def subscribe(self, topic):
+        self.packet_id = self.packet_id % 0xFFFF + 1
+        self.writer.write(packet(SUBSCRIBE, struct.pack("!H", self.packet_id) + mqtt_string(topic) + b"\x00"))
+
+    async def publish(self, topic, payload):
+        """Returns the bytes sent. Waits while the socket buffer is full, that is the broker's backpressure."""
+        data = packet(PUBLISH, mqtt_string(topic) + payload)
+        self.writer.write(data)
+        await self.writer.drain()
+        return len(data)
+
+    def ping(self):
+        self.writer.write(packet(PINGREQ))
+
+    async def read_loop(self):
+        """Until the connection closes"""
+        while True:
+            kind, body = await self.read_packet()
+            if kind & 0xF0 == PUBLISH:
+                length = struct.unpack_from("!H", body)[0]
+                # QoS 0 only, so no packet id follows the topic
+                self.on_message(body[2:2 + length].decode(), body[2 + length:])
+
+    def close(self):
+        if self.writer:
+            try:
+                self.writer.write(packet(DISCONNECT))
+            except (ConnectionError, RuntimeError):
+                pass
+            self.writer.close()
+            self.writer = None
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.counts = {"hr_published": 0, "requests": 0, "responses": 0, "bytes_out": 0, "connect_errors": 0,
+                       "disconnects": 0, "publish_errors": 0, "timeouts": 0, "malformed": 0}
+        self.latencies = []
+
+    def add(self, name, n=1):
+        self.counts[name] += n
+
+
+class Device:
+    """A simulated Pico: reconnects like PicoConnection's message pump, publishes on its own schedule"""
+    def __init__(self, fleet, index, unique_id):
+        self.fleet = fleet
+        self.unique_id = unique_id
+        self.client_id = "pico-" + unique_id
+        self.rng = random.Random(fleet.args.seed * 1000003 + index)
+        # Ids start at a random point per device, as in PicoConnection
+        self.next_id = self.rng.getrandbits(30)
+        self.pending = {}
+        self.conn = None
+
+    def on_message(self, topic, payload):
+        if topic != RESPONSE_TOPIC:
+            return
+        try:
+            response = json.loads(payload)
+            request_id = response["id"]
+            analysis = response["data"]["analysis"]
+            if not isinstance(analysis, dict):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            # Every device gets every response, so each garbled one counts once per device
+            self.fleet.stats.add("malformed")
+            return
+        sent = self.pending.pop(request_id, None)
+        if sent is None:
+            return
+        latency = time.monotonic() - sent
+        if latency > self.fleet.args.timeout:
+            # The Pico would have given up on it already
+            self.fleet.stats.add("timeouts")
+        else:
+            self.fleet.stats.add("responses")
+            self.fleet.stats.latencies.append(latency * 1000)
+
+    def hr_record(self):
+        mean_ppi = self.rng.gauss(820, 80)
+        rmssd = abs(self.rng.gauss(45, 15))
+        return {
+            "id": self.unique_id,
+            "time": int(time.time()),
+            "Mean HR": round(60000 / mean_ppi, 2),
+            "PPI (ms)": round(mean_ppi, 2),
+            "RMSSD": round(rmssd, 2),
+            "SDNN": round(abs(self.rng.gauss(55, 15)), 2),
+            "pNN50": round(self.rng.uniform(0, 40), 2),
+            "SD1": round(rmssd / 1.414, 2),
+            "SD2": round(abs(self.rng.gauss(70, 20)), 2),
+            "DFA a1": round(self.rng.uniform(0.7, 1.4), 2),
+        }
+
+    def kubios_request(self):
+        request_id = self.next_id
+        self.next_id = (request_id + 1) & 0x3FFFFFFF
+        ibi = synthetic_ibi(self.fleet.args.beats, seed=self.rng.getrandbits(32))
+        if self.fleet.args.compact:
+            return request_id, "%s/%s" % (REQUEST_TOPIC, RRI_FORMAT), bytes(encode_rri(request_id, ibi))
+        request = {"id": request_id, "type": "RRI", "data": ibi, "analysis": {"type": "readiness"}}
+        return request_id, REQUEST_TOPIC, json.dumps(request).encode()
+
+    def expire(self, now):
+        for request_id in [rid for rid, sent in self.pending.items() if now - sent > self.fleet.args.timeout]:
+            del self.pending[request_id]
+            self.fleet.stats.add("timeouts")
+
+    async def run(self, start_delay):
+        args = self.fleet.args
+        stats = self.fleet.stats
+        await asyncio.sleep(start_delay)
+        retry = 1.0
+        while not self.fleet.stopping:
+            self.conn = MQTTConnection(self.client_id, self.on_message)
+            try:
+                await self.conn.connect(args.host, args.port, args.connect_timeout)
+                self.conn.subscribe(RESPONSE_TOPIC)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                stats.add("connect_errors")
+                self.conn.close()
+                await asyncio.sleep(retry * self.rng.uniform(0.5, 1.5))
+                retry = min(retry * 2, 30)
+                continue
+            retry = 1.0
+            stats.connected += 1
+            reader = asyncio.ensure_future(self.conn.read_loop())
+            try:
+                await self.session(reader)
+            except (OSError, asyncio.IncompleteReadError, ConnectionError):
+                stats.add("publish_errors")
+            finally:
+                stats.connected -= 1
+                if reader.done() and not reader.cancelled():
+                    reader.exception()
+                reader.cancel()
+                self.conn.close()
+            if not self.fleet.stopping:
+                stats.add("disconnects")
+
+    async def session(self, reader):
+        args = self.fleet.args
+        stats = self.fleet.stats
+        now = time.monotonic()
+        # Spread the first publishes over the intervals so the fleet doesn't publish in lockstep
+        next_hr = now + self.rng.uniform(0, args.hr_interval)
+        next_kubios = now + self.rng.uniform(0, args.kubios_interval) if args.kubios_interval else None
+        next_ping = now + KEEPALIVE / 2
+        while not self.fleet.stopping and not reader.done():
+            now = time.monotonic()
+            self.expire(now)
+            if now >= next_hr:
+                stats.add("bytes_out", await self.conn.publish(HR_TOPIC, json.dumps(self.hr_record()).encode()))
+                stats.add("hr_published")
+                next_hr += args.hr_interval
+            if next_kubios is not None and now >= next_kubios:
+                request_id, topic, payload = self.kubios_request()
+                self.pending[request_id] = time.monotonic()
+                stats.add("bytes_out", await self.conn.publish(topic, payload))
+                stats.add("requests")
+                next_kubios += args.kubios_interval
+            if now >= next_ping:
+                self.conn.ping()
+                next_ping += KEEPALIVE / 2
+            wake = min(t for t in (next_hr, next_kubios, next_ping, now + 1) if t is not None)
+            await asyncio.sleep(max(0, wake - time.monotonic()))
+
+
+class Fleet:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.stopping = False
+        rng = random.Random(args.seed)
+        ids = set()
+        while len(ids) < args.devices:
+            # 8 bytes like machine.unique_id() on the Pico W
+            ids.add("%016x" % rng.getrandbits(64))
+        self.devices = [Device(self, i, unique_id) for i, unique_id in enumerate(sorted(ids))]
+
+    def snapshot(self):
+        return dict(self.stats.counts, connected=self.stats.connected, time=time.monotonic())
+
+    def report_line(self, last, current):
+        elapsed = current["time"] - last["time"]
+        published = current["hr_published"] + current["requests"] - last["hr_published"] - last["requests"]
+        latencies = self.stats.latencies
+        return (f"{current['time'] - self.started:6.0f}s  connected {current['connected']:5}  "
+                f"publish {published / elapsed:8.1f}/s  responses {current['responses']:6}  "
+                f"latency p50 {percentile(latencies, 50):6.0f} p95 {percentile(latencies, 95):6.0f} ms  "
+                f"errors {current['connect_errors'] + current['disconnects'] + current['publish_errors']:4}  "
+                f"timeouts {current['timeouts']:4}")
+
+    async def run(self):
+        args = self.args
+        self.started = time.monotonic()
+        tasks = [asyncio.ensure_future(device.run(args.ramp * i / len(self.devices)))
+                 for i, device in enumerate(self.devices)]
+        last = self.snapshot()
+        end = self.started + args.seconds
+        while time.monotonic() < end:
+            await asyncio.sleep(min(args.report, max(0, end - time.monotonic())))
+            current = self.snapshot()
+            print(self.report_line(last, current), flush=True)
+            last = current
+        self.stopping = True
+        await asyncio.sleep(0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for device in self.devices:
+            if device.conn:
+                device.conn.close()
+        return self.summary()
+
+    def summary(self):
+        counts = self.stats.counts
+        elapsed = time.monotonic() - self.started
+        latencies = self.stats.latencies
+        # Requests still waiting at the end are neither answered nor timed out
+        outstanding = sum(len(device.pending) for device in self.devices)
+        return dict(counts, devices=len(self.devices), seconds=round(elapsed, 1), outstanding=outstanding,
+                    publish_rate=round((counts["hr_published"] + counts["requests"]) / elapsed, 1),
+                    latency_ms={p: round(percentile(latencies, p), 1) for p in (50, 90, 95, 99, 100)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--ramp", type=float, default=10, help="s over which the devices connect")
+    parser.add_argument("--hr-interval", type=float, default=30, help="s between a device's hr-data records")
+    parser.add_argument("--kubios-interval", type=float, default=60, help="s between Kubios requests, 0 for none")
+    parser.add_argument("--beats", type=int, default=40, help="IBIs per Kubios request, 40 is about 30 s")
+    parser.add_argument("--compact", action="store_true", help="send RRI requests in the rri-delta-v1 format")
+    parser.add_argument("--timeout", type=float, default=6, help="s a request may take, KUBIOS_TIMEOUT_MS")
+    parser.add_argument("--connect-timeout", type=float, default=10)
+    parser.add_argument("--report", type=float, default=5, help="s between progress lines")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the summary to this file")
+    args = parser.parse_args()
+
+    summary = asyncio.run(Fleet(args).run())
+    latency = summary["latency_ms"]
+    print(f"\n{summary['devices']} devices for {summary['seconds']} s: {summary['hr_published']} hr-data, "
+          f"{summary['requests']} Kubios requests, {summary['publish_rate']} publishes/s, "
+          f"{summary['bytes_out'] / 1024:.0f} KB sent")
+    print(f"responses {summary['responses']}  timeouts {summary['timeouts']}  outstanding {summary['outstanding']}  "
+          f"malformed {summary['malformed']}")
+    print(f"latency ms: p50 {latency[50]}  p90 {latency[90]}  p95 {latency[95]}  p99 {latency[99]}  "
+          f"max {latency[100]}")
+    print(f"errors: connect {summary['connect_errors']}  disconnects {summary['disconnects']}  "
+          f"publish {summary['publish_errors']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
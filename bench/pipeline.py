@@ -0,0 +1,250 @@
+"""Throughput benchmarks for Detect_peaks and HRVAnalysis, run on the host through the sim package.
+
+    python -m bench.pipeline                       # 30 s, 5 min and 1 h cases
+    python -m bench.pipeline --long                # adds 24 h
+    python -m bench.pipeline --json out.json       # machine readable results
+    python -m bench.pipeline --compare base.json   # diff against an earlier run, exits 1 on regressions
+
+Detector cases report samples/s of Detect_peaks.run() (clock and ADC simulation excluded), a per-stage
+breakdown from a second instrumented pass and the tracemalloc peak (of at most 5 min of signal).
+The plot/oled_flush stages run on the pure Python framebuf stand-in, so their share is larger than on the Pico.
+HRV cases time HRVAnalysis.calculate on synthetic IBI series of the same durations, hrv_stream cases the
+per-beat HRVAccumulator updates (ibi_per_s) and the final result() call (seconds)."""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from array import array
+
+import sim
+
+clock = sim.install()
+
+from src.components.HR import Detect_peaks
+from src.components.HRV import HRVAnalysis, HRVAccumulator
+
+DURATIONS = {"30s": 30, "5min": 300, "1h": 3600}
+LONG_DURATIONS = {"24h": 86400}
+STEP_MS = 200
+# Detect_peaks / SignalPlotter methods timed in the instrumented pass, grouped into stages
+STAGES = {
+    "drain": ("drain",),
+    "window": ("process_chunk",),
+    "state": ("rising_edge", "falling_edge"),
+}
+# The state functions are called from inside process_chunk, report that stage exclusive of them
+NESTED = {"state": "window"}
+PLOTTER_STAGES = {
+    "plot": ("update_display", "display_countdown", "display_bpm"),
+    "oled_flush": ("show_oled",),
+}
+
+
+def ppg_loop(seconds=300):
+    """Five minutes of synthetic trace, repeated, so long cases don't hold hours of samples in RAM"""
+    return sim.traces.repeat(array("H", sim.traces.synthetic_ppg(seconds)))
+
+
+def instrument(obj, stages, totals):
+    for stage, names in stages.items():
+        totals.setdefault(stage, 0)
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is None:
+                continue
+
+            def timed(*args, _method=method, _stage=stage):
+                start = time.perf_counter_ns()
+                result = _method(*args)
+                totals[_stage] += time.perf_counter_ns() - start
+                return result
+
+            setattr(obj, name, timed)
+
+
+def drive_detector(seconds, instrumented=False):
+    clock.reset()
+    sim.feed_adc(ppg_loop())
+    detector = Detect_peaks()
+    totals = {}
+    if instrumented:
+        instrument(detector, STAGES, totals)
+        instrument(detector.plotter, PLOTTER_STAGES, totals)
+    detector.run()
+    busy = 0
+    for _ in range(int(seconds * 1000 // STEP_MS)):
+        clock.advance_ms(STEP_MS)
+        start = time.perf_counter_ns()
+        detector.run()
+        busy += time.perf_counter_ns() - start
+    for stage, parent in NESTED.items():
+        if stage in totals and parent in totals:
+            totals[parent] -= totals[stage]
+    samples = detector.sample_index + 1
+    return detector, samples, busy, totals
+
+
+def bench_detector(label, seconds):
+    # OLED transfers advance the virtual clock too, so slightly more than seconds * 250 samples get processed
+    detector, samples, busy, _ = drive_detector(seconds)
+    _, _, instrumented_busy, totals = drive_detector(seconds, instrumented=True)
+    stages = {stage: round(ns / instrumented_busy, 4) for stage, ns in totals.items()}
+    stages["other"] = round(max(0.0, 1 - sum(stages.values())), 4)
+
+    tracemalloc.start()
+    drive_detector(min(seconds, 300))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "name": f"detector/{label}",
+        "samples": samples,
+        "seconds": round(busy / 1e9, 4),
+        "samples_per_s": round(samples / (busy / 1e9)),
+        "realtime_factor": round(samples / (busy / 1e9) / 250, 1),
+        "stages": stages,
+        "peak_bytes": peak,
+        "dropped": detector.data.dropped(),
+    }
+
+
+def bench_hrv(label, seconds, rounds=5, round_ns=40_000_000):
+    ibi = sim.traces.synthetic_ibi(max(2, seconds * 1000 // 800))
+    hrv = HRVAnalysis()
+    best = None
+    for _ in range(rounds):
+        calls = 0
+        start = time.perf_counter_ns()
+        while True:
+            hrv.calculate(ibi)
+            calls += 1
+            elapsed = time.perf_counter_ns() - start
+            if elapsed >= round_ns:
+                break
+        per_call = elapsed / calls
+        best = per_call if best is None else min(best, per_call)
+
+    tracemalloc.start()
+    hrv.calculate(ibi)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "name": f"hrv/{label}",
+        "ibi_count": len(ibi),
+        "seconds": round(best / 1e9, 6),
+        "ibi_per_s": round(len(ibi) / (best / 1e9)),
+        "peak_bytes": peak,
+    }
+
+
+def bench_hrv_stream(label, seconds):
+    """Per-beat cost of HRVAccumulator.add and the cost of result() at the end of the window"""
+    ibi = sim.traces.synthetic_ibi(max(2, seconds * 1000 // 800))
+    accumulator = HRVAccumulator()
+    start = time.perf_counter_ns()
+    for value in ibi:
+        accumulator.add(value)
+    added = time.perf_counter_ns() - start
+    start = time.perf_counter_ns()
+    accumulator.result()
+    final = time.perf_counter_ns() - start
+
+    accumulator.reset()
+    tracemalloc.start()
+    for value in ibi:
+        accumulator.add(value)
+    accumulator.result()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "name": f"hrv_stream/{label}",
+        "ibi_count": len(ibi),
+        "seconds": round(final / 1e9, 6),
+        "ibi_per_s": round(len(ibi) / (added / 1e9)),
+        "peak_bytes": peak,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=sim.ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rate(result):
+    return result.get("samples_per_s") or result.get("ibi_per_s")
+
+
+def compare(results, baseline, threshold):
+    old = {result["name"]: result for result in baseline["results"]}
+    regressions = 0
+    print(f"\nvs {baseline.get('commit')}:")
+    for result in results:
+        if result["name"] not in old:
+            continue
+        ratio = rate(result) / rate(old[result["name"]])
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"  {result['name']:<16} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def print_result(result):
+    if "samples_per_s" in result:
+        stages = " ".join(f"{stage}={share:.0%}" for stage, share in result["stages"].items())
+        print(f"{result['name']:<16} {result['samples_per_s']:>9} samples/s {result['realtime_factor']:>7}x  "
+              f"peak {result['peak_bytes'] // 1024} KiB  [{stages}]")
+    else:
+        print(f"{result['name']:<16} {result['ibi_count']:>7} IBIs {result['seconds'] * 1000:9.2f} ms  "
+              f"peak {result['peak_bytes'] // 1024} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--long", action="store_true", help="include the 24 h cases")
+    parser.add_argument("--only", choices=("detector", "hrv"))
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier --json output to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown counted as regression")
+    args = parser.parse_args()
+
+    durations = dict(DURATIONS)
+    if args.long:
+        durations.update(LONG_DURATIONS)
+
+    results = []
+    for label, seconds in durations.items():
+        if args.only != "hrv":
+            results.append(bench_detector(label, seconds))
+            print_result(results[-1])
+        if args.only != "detector":
+            results.append(bench_hrv(label, seconds))
+            print_result(results[-1])
+            results.append(bench_hrv_stream(label, seconds))
+            print_result(results[-1])
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Times HRVAnalysis.calculate_frequency on a synthetic 5 minute recording.
+Run from the project root on a PC with `python -m bench.spectral_bench`
+or on the Pico with `mpremote run bench/spectral_bench.py` (src/ must be on the device)."""
+import math
+import time
+
+try:
+    import sim
+    sim.install()
+except ImportError:
+    pass
+
+from src.components.HRV import HRVAnalysis
+
+if hasattr(time, "perf_counter_ns"):
+    # Host: the simulator's ticks_us is virtual time, so measure with the real clock
+    ticks_us = lambda: time.perf_counter_ns() // 1000
+    ticks_diff = lambda a, b: a - b
+else:
+    ticks_us, ticks_diff = time.ticks_us, time.ticks_diff
+
+
+def synthetic_ibi(seconds):
+    """0.1 Hz (LF) and 0.25 Hz (HF) oscillations around 800 ms"""
+    ibi = []
+    t = 0
+    while t < seconds * 1000:
+        value = 800 + 30 * math.sin(2 * math.pi * 0.1 * t / 1000) + 20 * math.sin(2 * math.pi * 0.25 * t / 1000)
+        ibi.append(int(value))
+        t += value
+    return ibi
+
+
+def main():
+    ibi = synthetic_ibi(300)
+    hrv = HRVAnalysis()
+
+    start = ticks_us()
+    hrv.calculate_frequency(ibi[:80])
+    first = ticks_diff(ticks_us(), start)
+
+    runs = 5
+    start = ticks_us()
+    for _ in range(runs):
+        result = hrv.calculate_frequency(ibi)
+    elapsed = ticks_diff(ticks_us(), start) // runs
+
+    print(f"{len(ibi)} IBIs (5 min): {elapsed / 1000:.1f} ms per analysis, first call incl. tables {first / 1000:.1f} ms")
+    print(result)
+    if elapsed >= 1_000_000:
+        raise AssertionError("frequency domain analysis took over a second")
+
+
+if __name__ == '__main__':
+    main()
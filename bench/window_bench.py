@@ -0,0 +1,78 @@
+"""Compares the old list based Detect_peaks window against SlidingWindow.
+Run from the project root on a PC with `python -m bench.window_bench`
+or on the Pico with `mpremote run bench/window_bench.py` (src/ must be on the device)."""
+import math
+import time
+from src.components.window import SlidingWindow
+
+BUFFER_SIZE = 250
+SAMPLES = 5000
+
+try:
+    ticks_us, ticks_diff = time.ticks_us, time.ticks_diff
+except AttributeError:
+    ticks_us = lambda: time.perf_counter_ns() // 1000
+    ticks_diff = lambda a, b: a - b
+
+
+def synthetic_ppg(n, rate=250, bpm=72):
+    """Pulse-like 14 bit ADC trace with a slow baseline wander"""
+    samples = []
+    beat = 60 / bpm
+    for i in range(n):
+        t = i / rate
+        phase = (t % beat) / beat
+        pulse = math.exp(-((phase - 0.2) ** 2) / 0.004) + 0.4 * math.exp(-((phase - 0.45) ** 2) / 0.01)
+        samples.append(int(8000 + 3000 * pulse + 500 * math.sin(2 * math.pi * 0.25 * t)))
+    return samples
+
+
+def thresholds(min_val, max_val, baseline):
+    peak_range = max_val - min_val
+    return baseline + int(peak_range * 0.4), baseline + int(peak_range * 0.2)
+
+
+def run_list(samples):
+    """The pre-SlidingWindow buffer_maintain + min_max"""
+    window = []
+    out = []
+    for reading in samples:
+        if len(window) < BUFFER_SIZE:
+            window.append(reading)
+        elif len(window) == BUFFER_SIZE:
+            window.pop(0)
+            window.append(reading)
+        if len(window) == BUFFER_SIZE:
+            out.append(thresholds(min(window), max(window), sum(window) // len(window)) + (window[0],))
+    return out
+
+
+def run_sliding(samples):
+    window = SlidingWindow(BUFFER_SIZE)
+    out = []
+    for reading in samples:
+        window.push(reading)
+        if window.full():
+            out.append(thresholds(window.min(), window.max(), window.mean()) + (window.oldest(),))
+    return out
+
+
+def bench(name, func, samples):
+    start = ticks_us()
+    result = func(samples)
+    elapsed = ticks_diff(ticks_us(), start)
+    print(f"{name:>8}: {len(samples) * 1_000_000 // max(1, elapsed)} samples/s")
+    return result
+
+
+def main():
+    samples = synthetic_ppg(SAMPLES)
+    before = bench("list", run_list, samples)
+    after = bench("sliding", run_sliding, samples)
+    if before != after:
+        raise AssertionError("SlidingWindow thresholds differ from the list implementation")
+    print("thresholds identical")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+"""Services that run on the gateway machine next to the MQTT broker and the Kubios proxy, not on the Pico.
+They need desktop Python 3 and paho-mqtt (pip install paho-mqtt); attach() functions wire the same logic
+into the sim broker for testing without either."""
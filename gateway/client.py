@@ -0,0 +1,19 @@
+"""paho-mqtt client setup shared by the gateway services"""
+
+
+def connect(host, port, client_id, will=None):
+    """Connected paho client with its network loop not started yet. will is (topic, payload, retain)."""
+    try:
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        raise SystemExit("paho-mqtt is needed for this: pip install paho-mqtt")
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+    except AttributeError:
+        # paho-mqtt 1.x
+        client = mqtt.Client(client_id=client_id)
+    if will:
+        topic, payload, retain = will
+        client.will_set(topic, payload, retain=retain)
+    client.connect(host, port)
+    return client
@@ -0,0 +1,250 @@
+"""Stores the HRV results the Picos publish on hr-data in SQLite.
+
+    python -m gateway.hr_collector --host 192.168.9.253 --port 21883 --db hr.db
+    python -m gateway.hr_collector --db hr.db trend e661640843963727 RMSSD --days 30
+
+Records are checked against what HRVAnalysis.record / HRVStatistics.result publish and written in batches,
+one transaction per batch_size records or flush_ms. A record the Pico's outbox sends twice is stored once.
+
+The Pico's clock is not set over the network and starts at 2021-01-01 after every boot, so the time in a
+record only tells records of one device apart. It is kept as sent and is part of the key, together with the
+values that make a record unique. Trends are ordered by when a record was received, the (device, received)
+index makes one device's records over a time range a single range scan.
+
+    python -m gateway.hr_collector check
+
+stores a batch of unsynced records in memory and checks nothing but the resent copies is dropped."""
+import argparse
+import json
+import math
+import sqlite3
+import time
+
+TOPIC = "hr-data"
+BATCH_SIZE = 500
+FLUSH_MS = 1000
+
+# Published key -> column, and the range a value may have. The first four are always there,
+# HRVStatistics adds the nonlinear ones and the frequency domain ones come from the 5 minute HRV measurement.
+FIELDS = (
+    ("Mean HR", "mean_hr", 0, 300),
+    ("PPI (ms)", "ppi", 0, 5000),
+    ("RMSSD", "rmssd", 0, 5000),
+    ("SDNN", "sdnn", 0, 5000),
+    ("pNN50", "pnn50", 0, 100),
+    ("SD1", "sd1", 0, 5000),
+    ("SD2", "sd2", 0, 5000),
+    ("DFA a1", "dfa_a1", -5, 5),
+    ("VLF", "vlf", 0, 1e7),
+    ("LF", "lf", 0, 1e7),
+    ("HF", "hf", 0, 1e7),
+    ("LF/HF", "lf_hf", 0, 1e4),
+)
+REQUIRED = ("Mean HR", "PPI (ms)", "RMSSD", "SDNN")
+COLUMNS = {key: column for key, column, _, _ in FIELDS}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS hr_data (
+    device INTEGER NOT NULL REFERENCES devices(device),
+    time INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (device, time, ppi, rmssd)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hr_data_received ON hr_data (device, received);
+""" % ",\n    ".join("%s REAL" % column for _, column, _, _ in FIELDS)
+
+
+def validate(record):
+    """The record as (device uid, time, values by column). Raises ValueError for anything
+    HRVAnalysis.record would not have produced."""
+    if not isinstance(record, dict):
+        raise ValueError("not an object")
+    uid = record.get("id")
+    if not isinstance(uid, str) or len(uid) != 16 or any(c not in "0123456789abcdef" for c in uid):
+        raise ValueError("id is not a unique_id in hex")
+    timestamp = record.get("time")
+    if not isinstance(timestamp, int) or isinstance(timestamp, bool) or timestamp < 0:
+        raise ValueError("time is not a timestamp")
+    values = {}
+    for key, column, low, high in FIELDS:
+        value = record.get(key)
+        if value is None:
+            if key in REQUIRED:
+                raise ValueError("%s missing" % key)
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError("%s is not a number" % key)
+        if not low <= value <= high:
+            raise ValueError("%s out of range: %s" % (key, value))
+        values[column] = float(value)
+    return uid, timestamp, values
+
+
+class Collector:
+    """Validates hr-data messages and stores them a batch at a time"""
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_ms=FLUSH_MS):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.batch = []
+        self.first_pending = None
+        self.devices = dict(self.db.execute("SELECT uid, device FROM devices"))
+        self.stored = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.columns = ["device", "time", "received"] + [column for _, column, _, _ in FIELDS]
+        self.insert = "INSERT OR IGNORE INTO hr_data (%s) VALUES (%s)" % (
+            ", ".join(self.columns), ", ".join("?" * len(self.columns)))
+
+    def add(self, payload, received=None):
+        """One hr-data message. Returns False if it was rejected."""
+        received = int(received if received is not None else time.time())
+        try:
+            uid, timestamp, values = validate(json.loads(payload))
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError too
+            self.invalid += 1
+            print(f"Rejected hr-data: {e}")
+            return False
+        self.batch.append((uid, timestamp, received, values))
+        if self.first_pending is None:
+            self.first_pending = time.monotonic()
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return True
+
+    def device(self, uid):
+        device = self.devices.get(uid)
+        if device is None:
+            device = self.db.execute("INSERT INTO devices (uid) VALUES (?)", (uid,)).lastrowid
+            self.devices[uid] = device
+        return device
+
+    def flush_due(self):
+        return self.first_pending is not None and (time.monotonic() - self.first_pending) * 1000 >= self.flush_ms
+
+    def flush(self):
+        if not self.batch:
+            return
+        rows = [[self.device(uid), timestamp, received] + [values.get(column) for column in self.columns[3:]]
+                for uid, timestamp, received, values in self.batch]
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(self.insert, rows)
+            inserted = self.db.total_changes - before
+        self.stored += inserted
+        self.duplicates += len(rows) - inserted
+        self.batch = []
+        self.first_pending = None
+
+    def trend(self, uid, field, since=None, until=None):
+        """[(received, value)] of one published field (RMSSD, Mean HR...) for a device, oldest first"""
+        column = COLUMNS[field]
+        device = self.devices.get(uid)
+        if device is None:
+            return []
+        return self.db.execute(
+            "SELECT received, %s FROM hr_data WHERE device = ? AND received BETWEEN ? AND ? ORDER BY received, time"
+            % column,
+            (device, since or 0, until or 2 ** 62)).fetchall()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def attach(broker, path=":memory:", batch_size=BATCH_SIZE):
+    """Collects from the sim's in-process broker. Call flush() on the returned Collector before reading."""
+    collector = Collector(path, batch_size)
+    broker.subscribe(TOPIC, lambda topic, msg: collector.add(msg))
+    return collector
+
+
+def run(args):
+    from gateway.client import connect
+    collector = Collector(args.db, args.batch_size, args.flush_ms)
+    client = connect(args.host, args.port, "hr-collector")
+
+    def on_connect(client, *args):
+        client.subscribe(TOPIC)
+
+    def on_message(client, userdata, message):
+        collector.add(message.payload)
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    # The network loop runs on this thread, so the database is only ever used from here
+    try:
+        while True:
+            client.loop(timeout=min(args.flush_ms, 1000) / 1000)
+            if collector.flush_due():
+                collector.flush()
+    except KeyboardInterrupt:
+        client.disconnect()
+    finally:
+        collector.close()
+        print(f"{collector.stored} records stored, {collector.duplicates} duplicates, {collector.invalid} rejected")
+
+
+def trend(args):
+    collector = Collector(args.db)
+    since = time.time() - args.days * 86400 if args.days else None
+    for timestamp, value in collector.trend(args.device, args.field, since):
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), "" if value is None else value)
+    collector.close()
+
+
+def check(args):
+    """A batch of records from a device whose clock was never set, all received in the same second"""
+    collector = Collector(":memory:")
+    received = int(time.time())
+    boot = 1609459200  # 2021-01-01, where the Pico's clock starts
+    payloads = [json.dumps({"id": "e661640843963727", "time": boot + 40 * i, "Mean HR": 60 + i,
+                            "PPI (ms)": 1000 - 10 * i, "RMSSD": 30 + i, "SDNN": 40 + i}) for i in range(8)]
+    for payload in payloads:
+        collector.add(payload, received)
+    collector.flush()
+    stored = collector.stored
+    # The outbox sends the whole batch again when the acknowledgements were lost
+    for payload in payloads:
+        collector.add(payload, received + 5)
+    collector.flush()
+    rows = collector.trend("e661640843963727", "RMSSD")
+    collector.close()
+    print(f"{stored} of {len(payloads)} stored, {collector.duplicates} of {len(payloads)} resent ignored")
+    if stored != len(payloads) or collector.duplicates != len(payloads) or len(rows) != len(payloads):
+        raise SystemExit("check failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="hr-data.db")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--flush-ms", type=int, default=FLUSH_MS, help="longest a record waits for its batch")
+    commands = parser.add_subparsers(dest="command")
+    query = commands.add_parser("trend", help="print one field of a device's records")
+    query.add_argument("device", help="unique_id in hex, the id field of the records")
+    query.add_argument("field", choices=list(COLUMNS))
+    query.add_argument("--days", type=float, help="only the last DAYS days")
+    commands.add_parser("check", help="store a batch of unsynced records in memory, then resend it")
+    args = parser.parse_args()
+    if args.command == "trend":
+        trend(args)
+    elif args.command == "check":
+        check(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
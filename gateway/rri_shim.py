@@ -0,0 +1,61 @@
+"""Translates compact RRI requests from the Picos into the JSON requests the Kubios proxy takes.
+
+    python -m gateway.rri_shim --host 192.168.9.253 --port 21883
+
+While running it keeps a retained format list on kubios-request/formats, which tells the Picos they may
+send requests as src.components.rri_codec payloads on kubios-request/<format>. Its last will clears the
+list, so when the shim goes away the Picos fall back to JSON by themselves."""
+import argparse
+import json
+
+from src.components.rri_codec import FORMAT, decode_rri
+
+REQUEST_TOPIC = "kubios-request"
+FORMATS_TOPIC = "kubios-request/formats"
+COMPACT_TOPIC = "kubios-request/" + FORMAT
+
+
+def translate(payload):
+    """JSON Kubios request for a compact payload"""
+    return json.dumps(decode_rri(payload)).encode()
+
+
+def attach(broker):
+    """Runs the shim inside the sim's in-process broker"""
+    def on_request(topic, payload):
+        broker.publish(REQUEST_TOPIC, translate(payload))
+
+    broker.subscribe(COMPACT_TOPIC, on_request)
+    broker.publish(FORMATS_TOPIC, FORMAT, retain=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    from gateway.client import connect
+    client = connect(args.host, args.port, "rri-shim", will=(FORMATS_TOPIC, b"", True))
+
+    def on_connect(client, *args):
+        client.subscribe(COMPACT_TOPIC)
+        client.publish(FORMATS_TOPIC, FORMAT, retain=True)
+
+    def on_message(client, userdata, message):
+        try:
+            client.publish(REQUEST_TOPIC, translate(message.payload))
+        except (ValueError, IndexError) as e:
+            print(f"Dropped malformed request: {e}")
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        client.publish(FORMATS_TOPIC, b"", retain=True).wait_for_publish()
+        client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ from ssd1306 import SSD1306_I2C
 from src.utils import RotaryEncoder, SSD1306Wrapper, load_config
 from src.menus import MainMenu, MeasureHRMenu, HRVAnalysisMenu, HistoryMenu, SettingsMenu, KubiosMenu
 from src.wifi import PicoConnection
+from src.assets import storage
 import micropython
 # Config
 micropython.alloc_emergency_exception_buf(200)
@@ -27,33 +28,32 @@ main_menu = MainMenu(oled, pico_conn, ["MEASURE HR", "HRV ANALYSIS", "KUBIOS", "
 measure_hr_menu = MeasureHRMenu(oled, pico_conn, rot)
 hrv_analysis_menu = HRVAnalysisMenu(oled, pico_conn, rot)
 history_menu = HistoryMenu(oled, pico_conn, ["Back"], rot)
-settings_menu = SettingsMenu(oled, pico_conn ,["WiFi", "Brightness", "Back"], rot)
+settings_menu = SettingsMenu(oled, pico_conn ,["WiFi", "Brightness", "Recording", "Back"], rot)
 kubios_menu = KubiosMenu(oled, pico_conn, rot)
 menus = (main_menu, measure_hr_menu, hrv_analysis_menu, history_menu, settings_menu, kubios_menu)
 pico_conn.menus = menus
 
+menu_names = {"MAIN": main_menu, "MEASURE HR": measure_hr_menu, "HRV ANALYSIS": hrv_analysis_menu,
+              "HISTORY": history_menu, "SETTINGS": settings_menu, "KUBIOS": kubios_menu}
+
 async def menu_manager():
     current_menu = "MAIN"
     while True:
-        if current_menu == "MAIN":
-            current_menu = await main_menu.handle_input()
-        elif current_menu == "MEASURE HR":
-            current_menu = await measure_hr_menu.handle_input()
-        elif current_menu == "HRV ANALYSIS":
-            current_menu = await hrv_analysis_menu.handle_input()
-        elif current_menu == "HISTORY":
-            current_menu = await history_menu.handle_input()
-        elif current_menu == "SETTINGS":
-            current_menu = await settings_menu.handle_input()
-        elif current_menu == "KUBIOS":
-            current_menu = await kubios_menu.handle_input()
+        menu = menu_names[current_menu]
+        # The previous menu drew over the screen
+        menu.invalidate()
+        current_menu = await menu.handle_input()
 
 async def main():
     # Create tasks for connection management and menu handling
     connection_task = uasyncio.create_task(pico_conn.check_connection())
     menu_task = uasyncio.create_task(menu_manager())
+    # One MQTT session for the whole program, incoming messages go to pico_conn's handlers
+    mqtt_task = uasyncio.create_task(pico_conn.mqtt_pump())
+    # History segment rotation and migration of old history files, kept off the save path
+    storage_task = uasyncio.create_task(storage().maintain())
 
-    await uasyncio.gather(connection_task, menu_task)
+    await uasyncio.gather(connection_task, menu_task, mqtt_task, storage_task)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+"""Host-side hardware simulation: runs the firmware under CPython.
+
+    import sim
+    clock = sim.install()          # must happen before any firmware import
+    sim.feed_adc(sim.traces.synthetic_ppg())
+    from src.components.HR import Detect_peaks
+
+stubs/ shadows the MicroPython and pico-lib modules (machine, Piotimer, ssd1306, framebuf, network,
+umqtt.simple, uasyncio...). Time is virtual: clock.advance_ms() fires the Piotimer that fills Sensor.fifo,
+so traces can be pushed through as fast as the host runs, or clock.start(speed) runs it like hardware."""
+import os
+import sys
+
+from sim import traces
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+
+
+def install():
+    if STUBS not in sys.path:
+        sys.path.insert(0, STUBS)
+    if ROOT not in sys.path:
+        sys.path.insert(1, ROOT)
+    from sim.clock import clock, patch_time
+    patch_time()
+    return clock
+
+
+def feed_adc(samples, pin=26):
+    """Every ADC(pin).read_u16() takes the next value from samples"""
+    from machine import ADC
+    ADC.sources[pin] = iter(samples)
+
+
+def set_network(available=None, rssi=None):
+    import network
+    if available is not None:
+        network.link["available"] = available
+    if rssi is not None:
+        network.link["rssi"] = rssi
+
+
+def turn(rot, steps):
+    """Rotate a RotaryEncoder by steps detents, positive is clockwise"""
+    for _ in range(abs(steps)):
+        rot.b.value(0 if steps > 0 else 1)
+        rot.a.sim_trigger()
+
+
+def click(rot):
+    """Press the encoder button. Presses closer than rot.debounce ms of virtual time are ignored like on hardware."""
+    rot.sw.sim_trigger()
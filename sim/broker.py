@@ -0,0 +1,74 @@
+
+
+def topic_matches(pattern, topic):
+    """MQTT filter matching for + and # wildcards"""
+    if pattern == topic:
+        return True
+    p_parts = pattern.split("/")
+    t_parts = topic.split("/")
+    for i, part in enumerate(p_parts):
+        if part == "#":
+            return True
+        if i >= len(t_parts) or (part != "+" and part != t_parts[i]):
+            return False
+    return len(p_parts) == len(t_parts)
+
+
+class Broker:
+    """In-process MQTT broker used by the umqtt.simple stand-in.
+    Clients get messages queued to an inbox drained by check_msg()/wait_msg(),
+    services (Kubios responder, hr-data sink...) register plain callbacks with subscribe().
+    Retained messages are kept per topic and handed to clients when they subscribe."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.available = True
+        self.clients = {}
+        self.services = []
+        self.published = {}
+        self.retained = {}
+        self.bytes_in = 0
+
+    def attach(self, client):
+        if not self.available:
+            raise OSError("ECONNREFUSED")
+        self.clients[client.client_id] = client
+
+    def detach(self, client):
+        if self.clients.get(client.client_id) is client:
+            del self.clients[client.client_id]
+
+    def subscribe(self, pattern, handler):
+        """handler(topic, msg) is called synchronously for every matching publish"""
+        self.services.append((pattern, handler))
+
+    def client_subscribed(self, client, pattern):
+        for topic, msg in self.retained.items():
+            if topic_matches(pattern, topic):
+                client.inbox.append((topic.encode(), msg))
+
+    def publish(self, topic, msg, retain=False):
+        if isinstance(topic, bytes):
+            topic = topic.decode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        if retain:
+            # An empty retained message clears the topic
+            if msg:
+                self.retained[topic] = msg
+            else:
+                self.retained.pop(topic, None)
+        self.published[topic] = self.published.get(topic, 0) + 1
+        self.bytes_in += len(msg)
+        for client in list(self.clients.values()):
+            for pattern in client.subscriptions:
+                if topic_matches(pattern, topic):
+                    client.inbox.append((topic.encode(), msg))
+                    break
+        for pattern, handler in list(self.services):
+            if topic_matches(pattern, topic):
+                handler(topic, msg)
+
+
+broker = Broker()
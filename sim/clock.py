@@ -0,0 +1,128 @@
+import threading
+import time
+
+_real_monotonic = time.monotonic
+_real_sleep = time.sleep
+_real_time_ns = time.time_ns
+
+
+class VirtualClock:
+    """Virtual microsecond clock behind the simulated time.ticks_* functions and Piotimer.
+    Time only moves when advance_us() is called, either manually (benchmarks, as fast as the host allows)
+    or from the realtime driver thread started with start(speed)."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.us = 0
+        self.epoch_ns = _real_time_ns()
+        self.speed = 1.0
+        self.timers = []
+        self.seq = 0
+        self.driver = None
+        self.running = False
+
+    def ticks_us(self):
+        return self.us
+
+    def ticks_ms(self):
+        return self.us // 1000
+
+    def time_ns(self):
+        return self.epoch_ns + self.us * 1000
+
+    def add_timer(self, callback, period_us, periodic=True, arg=None):
+        """Register callback(arg) to fire every period_us (or once). Returns a handle for remove_timer()."""
+        with self.lock:
+            self.seq += 1
+            timer = [self.us + period_us, self.seq, period_us, periodic, callback, arg]
+            self.timers.append(timer)
+            return timer
+
+    def call_at_ms(self, ms, callback):
+        with self.lock:
+            return self.add_timer(lambda _: callback(), max(0, ms * 1000 - self.us), periodic=False)
+
+    def remove_timer(self, timer):
+        with self.lock:
+            if timer in self.timers:
+                self.timers.remove(timer)
+
+    def advance_us(self, us):
+        """Move time forward, firing every timer that falls due on the way in order"""
+        with self.lock:
+            target = self.us + us
+            while self.timers:
+                timer = min(self.timers)
+                if timer[0] > target:
+                    break
+                self.us = timer[0]
+                if timer[3]:
+                    timer[0] += timer[2]
+                else:
+                    self.timers.remove(timer)
+                timer[4](timer[5])
+            self.us = target
+
+    def advance_ms(self, ms):
+        self.advance_us(int(ms * 1000))
+
+    def start(self, speed=1.0, step_ms=1):
+        """Advance the clock from a background thread at speed x real time, like hardware timers would"""
+        self.speed = speed
+        self.running = True
+
+        def drive():
+            last = _real_monotonic()
+            while self.running:
+                _real_sleep(step_ms / 1000)
+                now = _real_monotonic()
+                self.advance_us(int((now - last) * 1_000_000 * self.speed))
+                last = now
+
+        self.driver = threading.Thread(target=drive, daemon=True)
+        self.driver.start()
+
+    def stop(self):
+        self.running = False
+        if self.driver:
+            self.driver.join()
+            self.driver = None
+
+
+clock = VirtualClock()
+
+
+def ticks_diff(new, old):
+    return new - old
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def sleep_us(us):
+    # Without the driver thread blocking sleeps cost no host time, timers still fire as during a real busy wait
+    if clock.running:
+        _real_sleep(us / 1_000_000 / clock.speed)
+    else:
+        clock.advance_us(int(us))
+
+
+def sleep_ms(ms):
+    sleep_us(ms * 1000)
+
+
+def patch_time():
+    """Add the MicroPython time extensions to the host time module, backed by the virtual clock"""
+    time.ticks_ms = clock.ticks_ms
+    time.ticks_us = clock.ticks_us
+    time.ticks_cpu = clock.ticks_us
+    # Wall clock reads inside the firmware follow virtual time too, otherwise a host that outruns the
+    # sample rate sees several beats within the same millisecond
+    time.time_ns = clock.time_ns
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
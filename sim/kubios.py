@@ -0,0 +1,235 @@
+"""Stand-ins for the services behind the broker: the Kubios proxy and the hr-data consumer.
+
+    python -m sim.kubios --requests 200 --in-flight 4 --latency 300-4000 --drop 0.05 --malformed 0.05
+
+runs PicoConnection against them and reports how many requests were answered in time, response latency
+and throughput. sim.run main attaches the same services, see --kubios-latency there.
+
+The analysis values follow Kubios's definitions loosely (population norms for the PNS/SNS indexes,
+Baevsky's stress index), close enough to look real on the OLED but not Kubios's exact numbers."""
+import argparse
+import json
+import math
+import random
+
+from sim.broker import broker as default_broker
+from sim.clock import clock
+
+REQUEST_TOPIC = "kubios-request"
+RESPONSE_TOPIC = "kubios-response"
+HR_DATA_TOPIC = "hr-data"
+
+
+def parse_latency(text):
+    """"300" or "300-4000" (uniform between) in ms"""
+    low, _, high = str(text).partition("-")
+    return int(low), int(high or low)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def analyse(ibi):
+    """Readiness analysis dict in the shape the Kubios proxy returns it"""
+    n = len(ibi)
+    mean_rr = sum(ibi) / n
+    diffs = [b - a for a, b in zip(ibi, ibi[1:])] or [0]
+    rmssd = math.sqrt(sum(d * d for d in diffs) / len(diffs))
+    sdnn = math.sqrt(sum((x - mean_rr) ** 2 for x in ibi) / n)
+    sd1 = rmssd / math.sqrt(2)
+    sd2 = math.sqrt(max(0.0, 2 * sdnn * sdnn - sd1 * sd1))
+    mean_hr = 60000 / mean_rr
+    # Baevsky: amplitude of the 50 ms histogram mode (%) / (2 * mode * range), Kubios reports the square root
+    bins = {}
+    for x in ibi:
+        bins[int(x // 50)] = bins.get(int(x // 50), 0) + 1
+    mode_bin = max(bins, key=bins.get)
+    amo = 100 * bins[mode_bin] / n
+    spread = max(max(ibi) - min(ibi), 50) / 1000
+    stress_index = math.sqrt(amo / (2 * (mode_bin * 50 + 25) / 1000 * spread))
+    pns = ((mean_rr - 926.9) / 90.4 + (rmssd - 42.0) / 15.0 + (sd1 / mean_rr * 100 - 3.12) / 1.15) / 3
+    sns = ((mean_hr - 66.0) / 9.1 + (stress_index - 10.0) / 3.5 + (sd2 / mean_rr * 100 - 7.6) / 2.5) / 3
+    return {
+        "mean_hr_bpm": round(mean_hr, 2),
+        "mean_rr_ms": round(mean_rr, 2),
+        "rmssd_ms": round(rmssd, 2),
+        "sdnn_ms": round(sdnn, 2),
+        "sd1_ms": round(sd1, 2),
+        "sd2_ms": round(sd2, 2),
+        "readiness": round(max(0.0, min(100.0, 50 + 20 * (pns - sns))), 1),
+        "pns_index": round(pns, 2),
+        "sns_index": round(sns, 2),
+        "stress_index": round(stress_index, 2),
+        "physiological_age": int(max(18, min(80, 75 - 0.8 * rmssd))),
+        "artefact_level": "VERY LOW",
+    }
+
+
+class KubiosResponder:
+    """Answers kubios-request after latency_ms (a (low, high) range), drops a drop_rate share of requests
+    and garbles a malformed_rate share of the answers. Times are virtual, the answers are published from
+    the clock when they fall due."""
+    def __init__(self, broker=default_broker, latency_ms=(300, 300), drop_rate=0.0, malformed_rate=0.0, seed=1):
+        self.broker = broker
+        self.latency_ms = latency_ms
+        self.drop_rate = drop_rate
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.answered = 0
+        self.dropped = 0
+        self.malformed = 0
+        self.invalid = 0
+        broker.subscribe(REQUEST_TOPIC, self.on_request)
+
+    def on_request(self, topic, msg):
+        self.requests += 1
+        try:
+            request = json.loads(msg)
+            ibi = [int(x) for x in request["data"]]
+            response = {"id": request["id"], "type": request["type"], "analysis": request["analysis"],
+                        "data": {"status": "ok", "analysis": analyse(ibi)}}
+        except (ValueError, KeyError, TypeError, ZeroDivisionError):
+            self.invalid += 1
+            return
+        if self.rng.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        payload = json.dumps(response)
+        if self.rng.random() < self.malformed_rate:
+            self.malformed += 1
+            payload = self.garble(response, payload)
+        delay = self.rng.randint(*self.latency_ms)
+        clock.call_at_ms(clock.ticks_ms() + delay, lambda: self.respond(payload))
+
+    def garble(self, response, payload):
+        kind = self.rng.randrange(3)
+        if kind == 0:
+            return payload[:len(payload) // 2]
+        if kind == 1:
+            del response["id"]
+        else:
+            response["data"] = {"status": "ok", "analysis": "n/a"}
+        return json.dumps(response)
+
+    def respond(self, payload):
+        self.answered += 1
+        self.broker.publish(RESPONSE_TOPIC, payload)
+
+    def summary(self):
+        return (f"Kubios: {self.requests} requests, {self.answered} answered ({self.malformed} malformed), "
+                f"{self.dropped} dropped, {self.invalid} invalid requests")
+
+
+class HrDataSink:
+    """Collects what the devices publish on hr-data as (virtual ms, message dict)"""
+    def __init__(self, broker=default_broker):
+        self.messages = []
+        self.invalid = 0
+        self.devices = {}
+        broker.subscribe(HR_DATA_TOPIC, self.on_message)
+
+    def on_message(self, topic, msg):
+        try:
+            message = json.loads(msg)
+            device = message["id"]
+        except (ValueError, KeyError, TypeError):
+            self.invalid += 1
+            return
+        self.messages.append((clock.ticks_ms(), message))
+        self.devices[device] = self.devices.get(device, 0) + 1
+
+    def summary(self):
+        return f"hr-data: {len(self.messages)} messages from {len(self.devices)} devices, {self.invalid} invalid"
+
+
+def attach(broker=default_broker, latency_ms=(300, 300), drop_rate=0.0, malformed_rate=0.0, seed=1):
+    """Both services on broker, returns (responder, sink)"""
+    return KubiosResponder(broker, latency_ms, drop_rate, malformed_rate, seed), HrDataSink(broker)
+
+
+async def measure(conn, count, in_flight, timeout_ms, seed):
+    import uasyncio
+    from sim.traces import synthetic_ibi
+
+    while not conn.mqtt_client:
+        await uasyncio.sleep_ms(10)
+    latencies = []
+    timed_out = 0
+    unsent = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal timed_out, unsent, next_request
+        while next_request < count:
+            n = next_request
+            next_request += 1
+            # Every series is different, otherwise the result cache answers instead of the responder
+            ibi = synthetic_ibi(40, seed=seed * 100000 + n)
+            start = clock.ticks_ms()
+            request = conn.submit_kubios(ibi, timeout_ms=timeout_ms)
+            if request is None:
+                unsent += 1
+                await uasyncio.sleep_ms(100)
+                continue
+            if await request.result() is None:
+                timed_out += 1
+            else:
+                latencies.append(clock.ticks_ms() - start)
+
+    start = clock.ticks_ms()
+    await uasyncio.gather(*[worker() for _ in range(in_flight)])
+    return latencies, timed_out, unsent, clock.ticks_ms() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--in-flight", type=int, default=1, help="requests PicoConnection keeps outstanding")
+    parser.add_argument("--latency", default="300", help="response latency in ms, or low-high")
+    parser.add_argument("--drop", type=float, default=0.0, help="share of requests never answered")
+    parser.add_argument("--malformed", type=float, default=0.0, help="share of answers garbled")
+    parser.add_argument("--timeout", type=int, default=6000, help="ms, KUBIOS_TIMEOUT_MS on the Pico")
+    parser.add_argument("--speed", type=float, default=20, help="virtual seconds per real second")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    import os
+    import tempfile
+    import sim
+    sim.install()
+    os.chdir(tempfile.mkdtemp(prefix="pico-kubios-"))
+    import uasyncio
+    from src.wifi import PicoConnection
+
+    responder, _ = attach(latency_ms=parse_latency(args.latency), drop_rate=args.drop,
+                          malformed_rate=args.malformed, seed=args.seed)
+    conn = PicoConnection("sim", "sim", "localhost", 1883, 5)
+    conn.wlan.active(True)
+    conn.wlan.connect("sim", "sim")
+
+    async def run():
+        pump = uasyncio.create_task(conn.mqtt_pump())
+        try:
+            return await measure(conn, args.requests, args.in_flight, args.timeout, args.seed)
+        finally:
+            pump.cancel()
+
+    clock.start(args.speed)
+    try:
+        latencies, timed_out, unsent, elapsed = uasyncio.run(run())
+    finally:
+        clock.stop()
+    print(responder.summary())
+    print(f"{len(latencies)} answered in time, {timed_out} timed out after {args.timeout} ms, {unsent} not sent")
+    print(f"latency ms: p50 {percentile(latencies, 50)}  p95 {percentile(latencies, 95)}  "
+          f"max {max(latencies, default=0)}")
+    print(f"{args.requests / (elapsed / 1000):.2f} requests/s over {elapsed / 1000:.1f} s of virtual time")
+
+
+if __name__ == "__main__":
+    main()
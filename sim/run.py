@@ -0,0 +1,118 @@
+"""Run the firmware or the beat detector on the host.
+
+    python -m sim.run detector --seconds 300 [--trace ppg.txt --shift 2] [--profile]
+    python -m sim.run main --speed 4 --seconds 90 --script "500:click,1500:cw,2500:click"
+
+In main mode the broker has a Kubios responder and an hr-data sink attached (sim.kubios), --kubios-latency,
+--kubios-drop and --kubios-malformed inject faults into the responses.
+"""
+import argparse
+import cProfile
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import _thread
+
+import sim
+
+
+def parse_script(text):
+    events = []
+    for item in filter(None, (part.strip() for part in (text or "").split(","))):
+        at, action = item.split(":")
+        events.append((int(at), action))
+    return events
+
+
+def schedule_script(clock, events, get_rot):
+    for at, action in events:
+        def fire(action=action):
+            rot = get_rot()
+            if action == "click":
+                sim.click(rot)
+            elif action.startswith("cw"):
+                sim.turn(rot, int(action[2:] or 1))
+            elif action.startswith("ccw"):
+                sim.turn(rot, -int(action[3:] or 1))
+        clock.call_at_ms(at, fire)
+
+
+def run_detector(clock, seconds, step_ms):
+    from src.components.HR import Detect_peaks
+    detector = Detect_peaks()
+    detector.run()
+    start = time.perf_counter()
+    for _ in range(int(seconds * 1000 // step_ms)):
+        clock.advance_ms(step_ms)
+        detector.run()
+    elapsed = time.perf_counter() - start
+    # OLED transfers advance the virtual clock as well, so count what was actually processed
+    samples = detector.sample_index + 1
+    print(f"{samples} samples in {elapsed:.2f}s: {samples / elapsed:.0f} samples/s "
+          f"({samples / elapsed / detector.sampling_rate:.1f}x real time)")
+    print(f"dropped: {detector.data.dropped()}  IBIs: {len(detector.ibi_raw)}  last BPM: {detector.bpm:.0f}")
+    return detector
+
+
+def run_main(clock, seconds, speed, events, services=()):
+    workdir = tempfile.mkdtemp(prefix="pico-sim-")
+    shutil.copy(os.path.join(sim.ROOT, "config.json"), workdir)
+    os.chdir(workdir)
+    globals_holder = {}
+    schedule_script(clock, events, lambda: globals_holder["module"].rot)
+    clock.call_at_ms(seconds * 1000, _thread.interrupt_main)
+
+    import main as firmware
+    globals_holder["module"] = firmware
+    clock.start(speed)
+    try:
+        firmware.uasyncio.run(firmware.main())
+    except KeyboardInterrupt:
+        print(f"Stopped after {seconds}s of virtual time, files in {workdir}")
+    finally:
+        clock.stop()
+    for service in services:
+        print(service.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=("detector", "main"))
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--speed", type=float, default=1.0, help="virtual seconds per real second (main mode)")
+    parser.add_argument("--step-ms", type=int, default=200, help="virtual time between Detect_peaks.run() calls")
+    parser.add_argument("--trace", help="recorded trace, one integer per line")
+    parser.add_argument("--shift", type=int, default=0, help="left shift applied to trace values, 2 for sensor values")
+    parser.add_argument("--bpm", type=float, default=72)
+    parser.add_argument("--script", help="encoder events as ms:action, action is click, cwN or ccwN")
+    parser.add_argument("--kubios-latency", default="300", help="Kubios response latency in ms, or low-high")
+    parser.add_argument("--kubios-drop", type=float, default=0.0, help="share of Kubios requests never answered")
+    parser.add_argument("--kubios-malformed", type=float, default=0.0, help="share of Kubios answers garbled")
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
+    clock = sim.install()
+    if args.trace:
+        sim.feed_adc(sim.traces.repeat(sim.traces.load_trace(args.trace, args.shift)))
+    else:
+        sim.feed_adc(sim.traces.synthetic_ppg(bpm=args.bpm))
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    if args.mode == "detector":
+        run_detector(clock, args.seconds, args.step_ms)
+    else:
+        from sim import kubios
+        services = kubios.attach(latency_ms=kubios.parse_latency(args.kubios_latency), drop_rate=args.kubios_drop,
+                                 malformed_rate=args.kubios_malformed)
+        run_main(clock, args.seconds, args.speed, parse_script(args.script), services)
+    if profiler:
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    main()
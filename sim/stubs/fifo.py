@@ -0,0 +1,35 @@
+"""Host copy of pico-lib's Fifo"""
+from array import array
+
+
+class Fifo:
+    def __init__(self, size, typecode='H'):
+        self.data = array(typecode, [0] * size)
+        self.head = 0
+        self.tail = 0
+        self.size = size
+        self.dc = 0
+
+    def put(self, value):
+        nh = (self.head + 1) % self.size
+        if nh != self.tail:
+            self.data[self.head] = value
+            self.head = nh
+        else:
+            self.dc = self.dc + 1
+
+    def get(self):
+        if self.head != self.tail:
+            val = self.data[self.tail]
+            self.tail = (self.tail + 1) % self.size
+            return val
+        raise RuntimeError("Fifo is empty")
+
+    def dropped(self):
+        return self.dc
+
+    def has_data(self):
+        return self.head != self.tail
+
+    def empty(self):
+        return self.head == self.tail
@@ -0,0 +1,26 @@
+"""Host copy of pico-lib's Filefifo: replays a text file with one integer per line"""
+from fifo import Fifo
+
+
+class Filefifo(Fifo):
+    def __init__(self, size, typecode='H', name='data.txt', repeat=True):
+        super().__init__(size, typecode)
+        self.name = name
+        self.repeat = repeat
+        self.file = open(name)
+
+    def _fill(self):
+        while (self.head + 1) % self.size != self.tail:
+            line = self.file.readline()
+            if not line:
+                if not self.repeat:
+                    break
+                self.file.seek(0)
+                continue
+            if line.strip():
+                self.put(int(line))
+
+    def get(self):
+        if self.empty():
+            self._fill()
+        return super().get()
@@ -0,0 +1,110 @@
+"""Host stand-in for the MicroPython framebuf module.
+Pixel exact for MONO_VLSB (the SSD1306 layout) and MONO_HLSB (the bitmaps).
+text() draws an 8x8 block pattern derived from the character code instead of the real font."""
+
+MONO_VLSB = 0
+MONO_HLSB = 3
+MONO_HMSB = 4
+
+
+class FrameBuffer:
+    def __init__(self, buffer, width, height, format, stride=None):
+        self.buffer = buffer
+        self.width = width
+        self.height = height
+        self.format = format
+        self.stride = stride or width
+
+    def _get(self, x, y):
+        if self.format == MONO_VLSB:
+            return (self.buffer[(y >> 3) * self.stride + x] >> (y & 7)) & 1
+        stride = (self.stride + 7) >> 3
+        if self.format == MONO_HLSB:
+            return (self.buffer[y * stride + (x >> 3)] >> (7 - (x & 7))) & 1
+        return (self.buffer[y * stride + (x >> 3)] >> (x & 7)) & 1
+
+    def _set(self, x, y, c):
+        if self.format == MONO_VLSB:
+            index = (y >> 3) * self.stride + x
+            bit = 1 << (y & 7)
+        else:
+            index = y * ((self.stride + 7) >> 3) + (x >> 3)
+            bit = 1 << (7 - (x & 7)) if self.format == MONO_HLSB else 1 << (x & 7)
+        if c:
+            self.buffer[index] |= bit
+        else:
+            self.buffer[index] &= ~bit & 0xff
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        if c is None:
+            return self._get(x, y)
+        self._set(x, y, c)
+
+    def fill(self, c):
+        self.buffer[:] = (b"\xff" if c else b"\x00") * len(self.buffer)
+
+    def fill_rect(self, x, y, w, h, c):
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(self.width, x + w), min(self.height, y + h)
+        for yy in range(y0, y1):
+            for xx in range(x0, x1):
+                self._set(xx, yy, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            self.fill_rect(x, y, w, h, c)
+            return
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def line(self, x1, y1, x2, y2, c):
+        dx, dy = abs(x2 - x1), -abs(y2 - y1)
+        sx, sy = (1 if x1 < x2 else -1), (1 if y1 < y2 else -1)
+        err = dx + dy
+        while True:
+            self.pixel(x1, y1, c)
+            if x1 == x2 and y1 == y2:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x1 += sx
+            if e2 <= dx:
+                err += dx
+                y1 += sy
+
+    def text(self, s, x, y, c=1):
+        for i, ch in enumerate(str(s)):
+            code = ord(ch)
+            if code == 32:
+                continue
+            for row in range(1, 7):
+                bits = (code * (row + 3)) & 0x3e
+                for col in range(1, 7):
+                    if bits & (1 << col):
+                        self.pixel(x + i * 8 + col, y + row, c)
+
+    def blit(self, fbuf, x, y, key=-1, palette=None):
+        for yy in range(fbuf.height):
+            for xx in range(fbuf.width):
+                c = fbuf._get(xx, yy)
+                if c != key:
+                    self.pixel(x + xx, y + yy, c)
+
+    def scroll(self, xstep, ystep):
+        copy = FrameBuffer(bytearray(self.buffer), self.width, self.height, self.format, self.stride)
+        for yy in range(self.height):
+            for xx in range(self.width):
+                sx, sy = xx - xstep, yy - ystep
+                if 0 <= sx < self.width and 0 <= sy < self.height:
+                    self._set(xx, yy, copy._get(sx, sy))
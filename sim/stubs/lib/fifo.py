@@ -0,0 +1 @@
+from fifo import Fifo
@@ -0,0 +1,32 @@
+"""Host stand-in for pico-lib's Led"""
+from machine import Pin, PWM
+
+
+class Led:
+    def __init__(self, pin, mode=Pin.OUT, brightness=1):
+        self.pin = Pin(pin, mode)
+        self.pwm = PWM(self.pin)
+        self._brightness = brightness
+        self._on = False
+
+    def on(self):
+        self._on = True
+
+    def off(self):
+        self._on = False
+
+    def toggle(self):
+        self._on = not self._on
+
+    def value(self, value=None):
+        if value is None:
+            return self._on
+        self._on = bool(value)
+
+    def brightness(self, value=None):
+        if value is None:
+            return self._brightness
+        self._brightness = value
+
+    def __call__(self, value=None):
+        return self.value(value)
@@ -0,0 +1 @@
+from umqtt.simple import MQTTClient, MQTTException
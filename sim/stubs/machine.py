@@ -0,0 +1,155 @@
+"""Host stand-in for the MicroPython machine module"""
+import threading
+
+from sim.clock import clock
+
+# Pin IRQs fire on the clock driver thread, disable_irq() holds them off like on the Pico
+_irq_lock = threading.RLock()
+
+_unique_id = bytes.fromhex("e661640843963727")
+
+
+def unique_id():
+    return _unique_id
+
+
+def set_unique_id(value):
+    global _unique_id
+    _unique_id = value
+
+
+def freq(hz=None):
+    return 125_000_000
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+def disable_irq():
+    _irq_lock.acquire()
+    return 1
+
+
+def enable_irq(state=1):
+    _irq_lock.release()
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    # Pin level per GPIO number, shared by every Pin object on that GPIO
+    levels = {}
+    handlers = {}
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        if value is not None:
+            Pin.levels[id] = value
+        elif id not in Pin.levels:
+            Pin.levels[id] = 1 if pull == Pin.PULL_UP else 0
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return Pin.levels[self.id]
+        Pin.levels[self.id] = 1 if value else 0
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(not self.value())
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        if handler is None:
+            Pin.handlers.pop(self.id, None)
+        else:
+            Pin.handlers[self.id] = handler
+
+    def sim_trigger(self):
+        """Fire the registered IRQ handler as if an edge happened"""
+        handler = Pin.handlers.get(self.id)
+        if handler:
+            with _irq_lock:
+                handler(self)
+
+
+class ADC:
+    # Sample iterators per pin, fed with sim.feed_adc()
+    sources = {}
+
+    def __init__(self, pin):
+        self.pin = pin.id if isinstance(pin, Pin) else pin
+        self.reads = 0
+
+    def read_u16(self):
+        self.reads += 1
+        source = ADC.sources.get(self.pin)
+        if source is None:
+            return 32768
+        try:
+            return next(source)
+        except StopIteration:
+            ADC.sources[self.pin] = None
+            return 32768
+
+
+class PWM:
+    def __init__(self, pin, freq=1000, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+
+    def deinit(self):
+        pass
+
+
+class I2C:
+    """Counts traffic and advances the virtual clock by the time the transfer would take on the bus"""
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.id = id
+        self.freq = freq
+        self.bytes_written = 0
+        self.transactions = 0
+
+    def _transfer(self, nbytes):
+        self.transactions += 1
+        self.bytes_written += nbytes
+        # start + address byte + 9 clocks per data byte
+        clock.advance_us((nbytes + 1) * 9 * 1_000_000 // self.freq + 10)
+
+    def scan(self):
+        return [0x3c]
+
+    def writeto(self, addr, buf, stop=True):
+        self._transfer(len(buf))
+        return len(buf)
+
+    def writevto(self, addr, vector, stop=True):
+        self._transfer(sum(len(buf) for buf in vector))
+
+    def readfrom(self, addr, nbytes, stop=True):
+        self._transfer(nbytes)
+        return bytes(nbytes)
@@ -0,0 +1,25 @@
+"""Host stand-in for the micropython module"""
+
+
+def const(value):
+    return value
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def schedule(func, arg):
+    func(arg)
+    return True
+
+
+def _identity(func):
+    return func
+
+
+native = viper = _identity
+
+
+def mem_info(verbose=False):
+    pass
@@ -0,0 +1,43 @@
+"""Host stand-in for the MicroPython network module"""
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+
+# Shared link state, changed from the simulation with sim.set_network()
+link = {"available": True, "rssi": -55, "ip": "192.168.9.100"}
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connecting = False
+        self.ssid = None
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = bool(is_active)
+
+    def connect(self, ssid=None, key=None):
+        self.ssid = ssid
+        self._connecting = True
+
+    def disconnect(self):
+        self._connecting = False
+
+    def isconnected(self):
+        return self._active and self._connecting and link["available"]
+
+    def ifconfig(self):
+        if self.isconnected():
+            return (link["ip"], "255.255.255.0", "192.168.9.1", "192.168.9.1")
+        return ("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0")
+
+    def status(self, param=None):
+        if param == "rssi":
+            return link["rssi"]
+        return STAT_GOT_IP if self.isconnected() else STAT_IDLE
@@ -0,0 +1,21 @@
+"""Host stand-in for pico-lib's Piotimer, driven by the virtual clock"""
+from sim.clock import clock
+
+
+class Piotimer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=0, mode=PERIODIC, freq=1, period=None, callback=None):
+        self.timer = None
+        self.init(mode=mode, freq=freq, period=period, callback=callback)
+
+    def init(self, mode=PERIODIC, freq=1, period=None, callback=None):
+        self.deinit()
+        period_us = period * 1000 if period else 1_000_000 // freq
+        self.timer = clock.add_timer(callback, period_us, periodic=mode == Piotimer.PERIODIC, arg=self)
+
+    def deinit(self):
+        if self.timer:
+            clock.remove_timer(self.timer)
+            self.timer = None
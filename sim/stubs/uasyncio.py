@@ -0,0 +1,34 @@
+"""Host stand-in for uasyncio on top of asyncio.
+Sleeps are scaled by the virtual clock speed so UI cadence keeps pace with the simulated sensor."""
+import asyncio as _asyncio
+from asyncio import *
+from sim.clock import clock
+
+
+async def sleep(t):
+    await _asyncio.sleep(t / clock.speed)
+
+
+async def sleep_ms(t):
+    await _asyncio.sleep(t / 1000 / clock.speed)
+
+
+def wait_for_ms(aw, timeout):
+    return _asyncio.wait_for(aw, timeout / 1000 / clock.speed)
+
+
+class ThreadSafeFlag:
+    """set() may be called from timer callbacks on the clock driver thread, so wait() polls the flag"""
+    def __init__(self):
+        self._flag = False
+
+    def set(self):
+        self._flag = True
+
+    def clear(self):
+        self._flag = False
+
+    async def wait(self):
+        while not self._flag:
+            await _asyncio.sleep(0.0005)
+        self._flag = False
@@ -0,0 +1,73 @@
+"""Host stand-in for umqtt.simple, connected to the in-process sim broker"""
+from sim.broker import broker
+import network
+
+
+class MQTTException(Exception):
+    pass
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=False, ssl_params={}):
+        self.client_id = client_id
+        self.server = server
+        self.port = port or 1883
+        self.keepalive = keepalive
+        self.cb = None
+        self.connected = False
+        self.subscriptions = []
+        self.inbox = []
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        pass
+
+    def _check(self):
+        if not self.connected or not network.link["available"] or not broker.available:
+            self.connected = False
+            raise OSError(-1)
+
+    def connect(self, clean_session=True):
+        if not network.link["available"]:
+            raise OSError("EHOSTUNREACH")
+        broker.attach(self)
+        self.connected = True
+        if clean_session:
+            self.subscriptions = []
+            self.inbox = []
+        return False
+
+    def disconnect(self):
+        broker.detach(self)
+        self.connected = False
+
+    def ping(self):
+        self._check()
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._check()
+        if not isinstance(msg, (bytes, bytearray, memoryview, str)):
+            raise TypeError("object with buffer protocol required")
+        broker.publish(bytes(topic) if isinstance(topic, bytearray) else topic,
+                       bytes(msg) if isinstance(msg, (bytearray, memoryview)) else msg, retain)
+
+    def subscribe(self, topic, qos=0):
+        self._check()
+        if isinstance(topic, bytes):
+            topic = topic.decode()
+        self.subscriptions.append(topic)
+        broker.client_subscribed(self, topic)
+
+    def wait_msg(self):
+        self._check()
+        if not self.inbox:
+            return None
+        topic, msg = self.inbox.pop(0)
+        if self.cb:
+            self.cb(topic, msg)
+        return None
+
+    def check_msg(self):
+        return self.wait_msg()
@@ -0,0 +1,88 @@
+import math
+import random
+import struct
+import sys
+from array import array
+
+PPG_MAGIC = b"PPG1"
+PPG_HEADER = "<4sHB"
+
+
+def synthetic_ppg(seconds=None, rate=250, bpm=72, hrv_ms=40, noise=200, seed=1):
+    """Yields read_u16() style samples of a pulse sensor trace.
+    Every beat gets its own interval (bpm +- hrv_ms jitter) so HRV metrics have something to measure.
+    Endless when seconds is None."""
+    rng = random.Random(seed)
+    mean_ibi = 60000 / bpm
+    total = None if seconds is None else int(seconds * rate)
+    n = 0
+    beat_start = 0.0
+    ibi = mean_ibi
+    while total is None or n < total:
+        t_ms = n * 1000 / rate
+        if t_ms - beat_start >= ibi:
+            beat_start += ibi
+            ibi = mean_ibi + rng.gauss(0, hrv_ms)
+        phase = (t_ms - beat_start) / ibi
+        pulse = math.exp(-((phase - 0.2) ** 2) / 0.004) + 0.4 * math.exp(-((phase - 0.45) ** 2) / 0.01)
+        wander = 2000 * math.sin(2 * math.pi * 0.2 * t_ms / 1000)
+        value = 32000 + 12000 * pulse + wander + rng.gauss(0, noise)
+        yield max(0, min(65535, int(value)))
+        n += 1
+
+
+def synthetic_ibi(count, mean_ibi=800, sdnn=50, seed=1):
+    """IBI series in ms, with a respiratory (HF) and a slower (LF) component plus noise"""
+    rng = random.Random(seed)
+    out = []
+    t = 0
+    for _ in range(count):
+        ibi = (mean_ibi + 0.5 * sdnn * math.sin(2 * math.pi * 0.25 * t / 1000)
+               + 0.5 * sdnn * math.sin(2 * math.pi * 0.1 * t / 1000) + rng.gauss(0, sdnn * 0.5))
+        ibi = int(max(300, min(2000, ibi)))
+        out.append(ibi)
+        t += ibi
+    return out
+
+
+def load_ppg(path):
+    """Reads a .ppg recording made on the Pico by TraceRecorder, returns (sampling rate, read_u16() samples)"""
+    with open(path, "rb") as f:
+        magic, rate, shift = struct.unpack(PPG_HEADER, f.read(struct.calcsize(PPG_HEADER)))
+        if magic != PPG_MAGIC:
+            raise ValueError(f"{path} is not a .ppg recording")
+        samples = array("H")
+        samples.frombytes(f.read())
+    if sys.byteorder != "little":
+        samples.byteswap()
+    return rate, [value << shift for value in samples]
+
+
+def load_trace(path, shift=0):
+    """Reads a recorded trace: a .ppg recording, or a text file with one integer per line, the format
+    filefifo.Filefifo replays. Use shift=2 for text traces stored as sensor values (read_u16() >> 2)."""
+    with open(path, "rb") as f:
+        is_ppg = f.read(len(PPG_MAGIC)) == PPG_MAGIC
+    if is_ppg:
+        return load_ppg(path)[1]
+    with open(path) as f:
+        return [int(line) << shift for line in f if line.strip()]
+
+
+def ppg_to_text(path, out):
+    """Converts a .ppg recording to Filefifo's text format, sensor values one per line"""
+    _, samples = load_ppg(path)
+    with open(out, "w") as f:
+        for value in samples:
+            f.write(f"{value >> 2}\n")
+
+
+def repeat(samples):
+    while True:
+        for sample in samples:
+            yield sample
+
+
+if __name__ == "__main__":
+    # python -m sim.traces recording.ppg data.txt
+    ppg_to_text(sys.argv[1], sys.argv[2])
@@ -0,0 +1,43 @@
+import framebuf
+from src import bitmaps
+from src.components.save_measurements import Measurements
+
+# Bitmap name in src/bitmaps.py -> (width, height) it is drawn at
+SIZES = {
+    "wifi": (15, 12),
+    "no_wifi": (17, 16),
+    "sig_low": (18, 14),
+    "sig_mid": (19, 14),
+    "sig_high": (19, 14),
+    "measure_hr": (110, 14),
+    "hrv_analysis": (117, 17),
+    "kubios": (77, 17),
+    "history": (79, 12),
+    "settings": (96, 16),
+}
+
+_icons = {}
+_storage = None
+
+
+def icon(name):
+    """FrameBuffer for a bitmap in src/bitmaps.py, shared by every menu.
+    Built on first use directly over the module's bytearray, the bitmap itself is never copied."""
+    fbuf = _icons.get(name)
+    if fbuf is None:
+        width, height = SIZES[name]
+        fbuf = framebuf.FrameBuffer(getattr(bitmaps, name), width, height, framebuf.MONO_HLSB)
+        _icons[name] = fbuf
+    return fbuf
+
+
+def icon_width(name):
+    return SIZES[name][0]
+
+
+def storage():
+    """The one Measurements instance, so the history is only opened once and every menu sees the same state"""
+    global _storage
+    if _storage is None:
+        _storage = Measurements()
+    return _storage
@@ -1,20 +1,27 @@
 import time
+import uasyncio
+from array import array
 from machine import ADC
 from lib.led import Led
 from fifo import Fifo
 from piotimer import Piotimer
 import micropython
 from src.components.hr_display import SignalPlotter
+from src.components.window import SlidingWindow
+from src.components.recorder import TraceRecorder
 micropython.alloc_emergency_exception_buf(200)
 
 SAMPLE_RATE = 250 
 BUFFER_SIZE = 250
+FIFO_SIZE = 300
+# Cadence of the detection task. The fifo holds 1.2 s of samples, this leaves room for slow menu work
+SENSOR_INTERVAL_MS = 30
 
 class Sensor:
     def __init__(self, pin=26, sampling_rate=250):
         self.sensor = ADC(pin)
         self.sampling_rate = sampling_rate
-        self.fifo = Fifo(300, 'H')
+        self.fifo = Fifo(FIFO_SIZE, 'H')
 
     def start(self):
         return Piotimer(mode = Piotimer.PERIODIC, freq=250, callback=self.read_sensor)
@@ -26,19 +33,86 @@ class Sensor:
         count = ((self.fifo.head - self.fifo.tail) + self.fifo.size) % self.fifo.size
         return count
 
+class BeatQueue:
+    """IBIs from the detection task to whoever consumes them. put() never blocks: when the consumer falls
+    behind, the oldest IBIs are overwritten (counted in lost) so detection is never held up."""
+    def __init__(self, size=32):
+        self.data = array('H', [0] * size)
+        self.size = size
+        self.event = uasyncio.Event()
+        self.clear()
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self.lost = 0
+
+    def put(self, ibi):
+        self.data[(self.head + self.count) % self.size] = ibi
+        if self.count == self.size:
+            self.head = (self.head + 1) % self.size
+            self.lost += 1
+        else:
+            self.count += 1
+        self.event.set()
+
+    def get_nowait(self):
+        if not self.count:
+            return None
+        ibi = self.data[self.head]
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+        return ibi
+
+    async def get(self, timeout_ms=None):
+        """Next IBI, None if timeout_ms passes first"""
+        while not self.count:
+            self.event.clear()
+            if timeout_ms is None:
+                await self.event.wait()
+                continue
+            try:
+                await uasyncio.wait_for_ms(self.event.wait(), timeout_ms)
+            except uasyncio.TimeoutError:
+                return None
+        return self.get_nowait()
+
+
 class Detect_peaks:
+    # Detection tasks running on any instance. Blocking work like opening a connection waits while there
+    # are any, the fifo only holds a little over a second of samples.
+    running = 0
+
     def __init__(self):
         self.timer = None
+        # Detection task started by start(), and the time its countdown runs to
+        self.task = None
+        self.end_time = None
+        # Every new IBI, for menus to consume
+        self.beats = BeatQueue()
+        # Optional HRVAccumulator fed with every new IBI
+        self.hrv = None
+        # Raw sample recording, set up when a measurement starts with TraceRecorder.enabled
+        self.recorder = None
         self.plotter = SignalPlotter()
+        self.window = SlidingWindow(BUFFER_SIZE)
+        # Pending samples are copied here from the fifo in one go and processed as a chunk
+        self.chunk = array('H', [0] * FIFO_SIZE)
+        self.chunk_view = memoryview(self.chunk)
         self.reset()
        
     
     def reset(self):
         self.sensor = Sensor(26)
         self.data = self.sensor.fifo
+        self.fifo_view = memoryview(self.data.data)
         self.reading = 0
+        # Acquisition index of the latest sample taken from the fifo, beats are stamped with this
+        # instead of the wall clock so processing delays don't distort the IBIs
+        self.sample_index = -1
+        self.dropped = 0
         self.sampling_rate = self.sensor.sampling_rate
-        self.window = []
+        self.window.reset()
         self.min_val = 0
         self.max_val = 0
         self.threshold = 0
@@ -59,73 +133,104 @@ class Detect_peaks:
         self.ibi = 0
         self.ibi_values = []
         self.ibi_raw = []
+        self.beats.clear()
         self.plotter.reset()
+        if self.hrv:
+            self.hrv.reset()
+        if self.recorder:
+            self.recorder.stop()
+            self.recorder = None
 
         if self.timer: self.timer.deinit()
     
-    def buffer_maintain(self):
-        self.reading = self.data.get()     
-
-        if len(self.window) < BUFFER_SIZE:
-            self.window.append(self.reading)
-        elif len(self.window) == BUFFER_SIZE:
-            self.window.pop(0)
-            self.window.append(self.reading)
-    
-    def min_max(self):
-        if len(self.window) == BUFFER_SIZE:
-            self.min_val = min(self.window)
-            self.max_val = max(self.window)
+    def drain(self):
+        """Copy every pending sample out of the fifo into self.chunk, returns the sample count.
+        Only the tail is written here and head is read once, so the sampling interrupt can keep adding meanwhile."""
+        fifo = self.data
+        head = fifo.head
+        tail = fifo.tail
+        if head >= tail:
+            n = head - tail
+            self.chunk_view[0:n] = self.fifo_view[tail:head]
+        else:
+            first = fifo.size - tail
+            self.chunk_view[0:first] = self.fifo_view[tail:fifo.size]
+            self.chunk_view[first:first + head] = self.fifo_view[0:head]
+            n = first + head
+        fifo.tail = head
+        return n
 
-            baseline = sum(self.window) // len(self.window)
-            peak_range = self.max_val - self.min_val
-            
-            self.threshold = baseline + int(peak_range * 0.4)
-            self.margin = baseline + int(peak_range * 0.2)
+    def process_chunk(self, n):
+        """Window maintenance, thresholds and the state machine for n samples of self.chunk"""
+        window = self.window
+        push = window.push
+        chunk = self.chunk
+        for i in range(n):
+            push(chunk[i])
+            self.sample_index += 1
+            if window.length == BUFFER_SIZE:
+                min_val = window.min()
+                max_val = window.max()
+                baseline = window.mean()
+                peak_range = max_val - min_val
+
+                self.threshold = baseline + int(peak_range * 0.4)
+                self.margin = baseline + int(peak_range * 0.2)
+            self.state()
+
+        self.reading = chunk[n - 1]
+        if window.length == BUFFER_SIZE:
+            self.min_val = min_val
+            self.max_val = max_val
 
     def rising_edge(self):
-        if self.window[0] >= self.threshold and not self.up:
+        sample = self.window.oldest()
+        if sample >= self.threshold and not self.up:
             if self.validate_count == 10:
                 self.up = True
                 self.fall = False
                 self.validate_count = 0
 
-            self.count.append(self.window[0])
+            self.count.append(sample)
             self.validate_count += 1           
         
-        if self.window[0] <= self.threshold:
+        if sample <= self.threshold:
             self.validate_count = 0
             self.count.clear()
 
-        if self.window[0] > self.margin and self.up:
+        if sample > self.margin and self.up:
             self.fall = True
-            self.count.append(self.window[0])
+            self.count.append(sample)
         
         else:
-            self.valid_peaks.append(time.time_ns() // 1_000_000)
+            self.valid_peaks.append(self.sample_time_ms())
             self.up = False
             self.state = self.falling_edge
         
     
     def falling_edge(self):
-        if self.window[0] <= self.margin:
+        sample = self.window.oldest()
+        if sample <= self.margin:
             if self.validate_count == 10:
                 self.fall = True
             
-            self.count.append(self.window[0])
+            self.count.append(sample)
             self.validate_count += 1
             
-        if self.window[0] > self.threshold and not self.fall:
+        if sample > self.threshold and not self.fall:
             self.validate_count = 0
             self.valid_peaks.pop()
             self.count.clear()
             self.state = self.rising_edge
             
-        if self.window[0] > self.threshold and self.fall: 
+        if sample > self.threshold and self.fall: 
             self.fall = False
             if len(self.valid_peaks) == 2:
                 ibi = self.valid_peaks[1] - self.valid_peaks[0]
                 self.ibi_raw.append(ibi)
+                self.beats.put(ibi)
+                if self.hrv:
+                    self.hrv.add(ibi)
                 if len(self.ibi_values) < 20:
                     self.ibi_values.append(ibi)
                 else:
@@ -136,22 +241,66 @@ class Detect_peaks:
                 self.valid_peaks.clear()
             self.state = self.rising_edge
 
+    def sample_time_ms(self):
+        return self.sample_index * 1000 // self.sampling_rate
+
+    def sync_dropped(self, dropped):
+        """Samples the fifo had to drop still took time, skip their indexes so later beats stay on the sample clock.
+        dropped is the fifo's count from before the drain, those samples came after the ones it held then."""
+        if dropped != self.dropped:
+            self.sample_index += dropped - self.dropped
+            if self.recorder:
+                self.recorder.pad(dropped - self.dropped)
+            self.dropped = dropped
+
     def get_ibi(self):
         if self.ibi_raw:
             return self.ibi_raw
         raise RuntimeWarning("NO IBI DATA")
 
             
+    def start(self, duration_ms=None):
+        """Starts a measurement with detection in its own task, so it keeps pace with the sensor whatever
+        the menus are doing. With duration_ms the plot counts down to its end; the task runs until stop()."""
+        self.stop()
+        self.end_time = time.ticks_add(time.ticks_ms(), duration_ms) if duration_ms else None
+        self.task = uasyncio.create_task(self.process())
+        Detect_peaks.running += 1
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+            Detect_peaks.running -= 1
+        self.reset()
+
+    async def process(self):
+        while True:
+            countdown = None
+            if self.end_time is not None:
+                countdown = max(0, time.ticks_diff(self.end_time, time.ticks_ms()) // 1000)
+            self.run(countdown)
+            await uasyncio.sleep_ms(SENSOR_INTERVAL_MS)
+
     def run(self, countdown=None):
         if not self.started:
             self.reset()
+            if TraceRecorder.enabled:
+                self.recorder = TraceRecorder(self.sampling_rate)
+                self.recorder.start()
             self.timer = self.sensor.start()
             self.started = True
 
-        while self.data.has_data():
-            self.buffer_maintain()
-            self.min_max()
-            self.state()
+        dropped = self.data.dropped()
+        while True:
+            n = self.drain()
+            if not n:
+                break
+            self.process_chunk(n)
+            if self.recorder:
+                self.recorder.write(self.chunk_view, n)
+            # The gap goes after the first chunk, which holds what was in the fifo when it overflowed
+            self.sync_dropped(dropped)
 
             if (time.ticks_diff(time.ticks_ms(), self.prev_update_time) > int(60000 / 180 / 10)):
                 self.prev_update_time = time.ticks_ms()
@@ -163,3 +312,10 @@ class Detect_peaks:
 
                 self.plotter.show_oled()
                 self.plotter.display_bpm(self.bpm)
+                if self.hrv and self.hrv.count > 1:
+                    self.plotter.display_hrv(self.hrv.rmssd(), self.hrv.sdnn())
+
+        self.sync_dropped(dropped)
+        # A full block is written only now, with the fifo just emptied
+        if self.recorder:
+            self.recorder.flush()
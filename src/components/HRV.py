@@ -1,6 +1,10 @@
 import math, time, machine
+from src.components.spectrum import SpectralAnalysis
 
 class HRVAnalysis:
+    # Tables and buffers for the frequency domain are only allocated on first use
+    spectrum = None
+
     @staticmethod
     def filter(IBI_list_raw):
         IBI_list = []
@@ -17,40 +21,6 @@ class HRVAnalysis:
                 IBI_list.append(IBI_list_raw[i])
         return IBI_list
 
-    @staticmethod
-    def calculate_mean_hr(ibi_list):
-        mean_ibi = sum(ibi_list) / len(ibi_list)
-        mean_hr = 60000 / mean_ibi
-        return round(mean_hr, 2)
-    
-    @staticmethod
-    def calculate_mean_ppi(ibi_list):
-        mean_ppi = sum(ibi_list) / len(ibi_list)
-        return round(mean_ppi, 2)
-    
-    @staticmethod
-    def calculate_rmssd(ibi_list):
-        average = 0
-        for i in range(1, len(ibi_list), 1):
-            difference = (ibi_list[i] - ibi_list[i - 1]) ** 2
-            average += difference
-        average /= len(ibi_list) - 1
-        rmssd = math.sqrt(average)
-        return round(rmssd)
-    
-    @staticmethod
-    def calculate_sdnn(ibi_list):
-        if len(ibi_list) < 2:
-            return 0
-        
-        mean_ibi = sum(ibi_list) / len(ibi_list)
-        
-        squared_diff = [(ibi - mean_ibi) ** 2 for ibi in ibi_list]
-        
-        variance = sum(squared_diff) / (len(ibi_list) - 1)
-        sdnn = math.sqrt(variance)
-        return round(sdnn, 2)
-    
     @staticmethod
     def estimate_autonomic_balance(rmssd):
     
@@ -66,19 +36,201 @@ class HRVAnalysis:
         
         return round(sns, 2), round(pns, 2)
 
-    def calculate(self, ibi):
-        if len(ibi) < 0:
-            return 0
-        filtered_ibi = self.filter(ibi)
-        mean_hr = self.calculate_mean_hr(filtered_ibi)
-        mean_ppi = self.calculate_mean_ppi(filtered_ibi)
-        rmssd = self.calculate_rmssd(filtered_ibi)
-        sdnn = self.calculate_sdnn(filtered_ibi)
-        return {  
+    @staticmethod
+    def record(mean_hr, mean_ppi, rmssd, sdnn, nonlinear=None, frequency=None):
+        result = {  
             "id": machine.unique_id().hex(),
             "time": int(time.time()),
             "Mean HR": mean_hr,
             "PPI (ms)": mean_ppi,
             "RMSSD": rmssd,
             "SDNN": sdnn,
-        }
\ No newline at end of file
+        }
+        if nonlinear:
+            result.update(nonlinear)
+        if frequency:
+            result.update(frequency)
+        return result
+
+    @staticmethod
+    def calculate_frequency(ibi):
+        """VLF/LF/HF power (ms^2) and LF/HF ratio of the filtered IBIs, None for recordings under a minute"""
+        if not ibi:
+            return None
+        if HRVAnalysis.spectrum is None:
+            HRVAnalysis.spectrum = SpectralAnalysis()
+        return HRVAnalysis.spectrum.analyse(HRVAnalysis.filter(ibi))
+
+    def calculate(self, ibi):
+        if len(ibi) < 0:
+            return 0
+        stats = HRVStatistics()
+        for value in self.filter(ibi):
+            stats.update(value)
+        return stats.result()
+
+
+# Box sizes (beats) for short term DFA
+DFA_SCALES = tuple(range(4, 17))
+
+
+class HRVStatistics:
+    """All HRV metrics from a single pass over accepted IBIs, update() once per beat.
+    Welford mean/variance gives SDNN (and stays accurate with the Pico's 32 bit floats), successive differences
+    give RMSSD, pNN50 and Poincare SD1/SD2. DFA a1 keeps per scale sums of the integrated series for the box
+    currently filling; a linear fit per box removes any offset, so the series can be integrated before its mean
+    is known. All box sums are integers, so there is no float cancellation either."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.prev = 0
+        self.diff_count = 0
+        self.diff_sum = 0
+        self.sq_diff_sum = 0
+        self.nn50 = 0
+        self.first = 0
+        self.profile = 0
+        # Per scale: [position in box, sum y, sum x*y, sum y^2, sum of box residuals, finished boxes]
+        self.dfa = [[0, 0, 0, 0, 0.0, 0] for _ in DFA_SCALES]
+
+    def update(self, ibi):
+        if self.count:
+            diff = ibi - self.prev
+            self.diff_sum += diff
+            self.sq_diff_sum += diff * diff
+            self.diff_count += 1
+            if diff > 50 or diff < -50:
+                self.nn50 += 1
+        else:
+            self.first = ibi
+        self.prev = ibi
+        self.count += 1
+        delta = ibi - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (ibi - self.mean)
+
+        y = self.profile + ibi - self.first
+        self.profile = y
+        for i, box in enumerate(self.dfa):
+            x = box[0]
+            box[1] += y
+            box[2] += x * y
+            box[3] += y * y
+            x += 1
+            if x == DFA_SCALES[i]:
+                n = x
+                # Residual of the least squares line through the box, kept in integers until the last division
+                a = n * box[3] - box[1] * box[1]
+                b = n * box[2] - box[1] * n * (n - 1) // 2
+                box[4] += (a * n * n * (n * n - 1) - 12 * b * b) / (n * n * n * (n * n - 1))
+                box[5] += 1
+                x = box[1] = box[2] = box[3] = 0
+            box[0] = x
+
+    def rmssd(self):
+        if not self.diff_count:
+            return 0
+        return round(math.sqrt(self.sq_diff_sum / self.diff_count))
+
+    def sdnn(self):
+        if self.count < 2:
+            return 0
+        return round(math.sqrt(self.m2 / (self.count - 1)), 2)
+
+    def pnn50(self):
+        if not self.diff_count:
+            return 0
+        return round(100 * self.nn50 / self.diff_count, 1)
+
+    def poincare(self):
+        """SD1, SD2: SD1^2 = var(successive differences) / 2, SD2^2 = 2 * SDNN^2 - SD1^2"""
+        if self.diff_count < 2 or self.count < 2:
+            return 0, 0
+        diff_var = (self.sq_diff_sum - self.diff_sum * self.diff_sum / self.diff_count) / (self.diff_count - 1)
+        sd1_sq = diff_var / 2
+        sd2_sq = 2 * self.m2 / (self.count - 1) - sd1_sq
+        return round(math.sqrt(sd1_sq), 2), round(math.sqrt(max(0, sd2_sq)), 2)
+
+    def dfa_alpha1(self):
+        """Slope of log F(n) against log n over scales with at least two finished boxes, 0 if fewer than 3"""
+        points = []
+        for i, box in enumerate(self.dfa):
+            n = DFA_SCALES[i]
+            if box[5] >= 2 and box[4] > 0:
+                points.append((math.log(n), 0.5 * math.log(box[4] / (box[5] * n))))
+        if len(points) < 3:
+            return 0
+        mean_x = sum(p[0] for p in points) / len(points)
+        mean_y = sum(p[1] for p in points) / len(points)
+        sxy = sum((p[0] - mean_x) * (p[1] - mean_y) for p in points)
+        sxx = sum((p[0] - mean_x) ** 2 for p in points)
+        return round(sxy / sxx, 2)
+
+    def nonlinear(self):
+        sd1, sd2 = self.poincare()
+        return {
+            "pNN50": self.pnn50(),
+            "SD1": sd1,
+            "SD2": sd2,
+            "DFA a1": self.dfa_alpha1(),
+        }
+
+    def result(self, frequency=None):
+        """frequency: calculate_frequency() of the same recording, added to the record when there is one"""
+        if not self.count:
+            return HRVAnalysis.record(0, 0, 0, 0, {"pNN50": 0, "SD1": 0, "SD2": 0, "DFA a1": 0})
+        return HRVAnalysis.record(round(60000 / self.mean, 2), round(self.mean, 2), self.rmssd(), self.sdnn(),
+                                  self.nonlinear(), frequency)
+
+
+class HRVAccumulator(HRVStatistics):
+    """HRVStatistics fed beat by beat during collection, so results are ready the moment it ends.
+    Outliers are gated like HRVAnalysis.filter but against the running mean of the raw IBIs; the first
+    warmup beats are held back until that mean has settled."""
+    def __init__(self, warmup=5):
+        self.warmup = warmup
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self.pending = []
+        self.raw_count = 0
+        self.raw_sum = 0
+
+    def add(self, ibi):
+        self.raw_count += 1
+        self.raw_sum += ibi
+        if self.raw_count < self.warmup:
+            self.pending.append(ibi)
+            return
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+            for value in pending:
+                self.accept(value)
+        self.accept(ibi)
+
+    def accept(self, ibi):
+        mean_ibi = self.raw_sum / self.raw_count
+        threshold_lower = mean_ibi * 0.7
+        if threshold_lower < 300:
+            threshold_lower = 300
+        if not threshold_lower < ibi < mean_ibi * 1.3:
+            return False
+        self.update(ibi)
+        return True
+
+    def flush(self):
+        """Gate beats still held for warmup, for recordings shorter than the warmup"""
+        pending = self.pending
+        self.pending = []
+        for value in pending:
+            self.accept(value)
+
+    def result(self, frequency=None):
+        self.flush()
+        return super().result(frequency)
@@ -2,11 +2,12 @@ from machine import Pin, I2C
 from ssd1306 import SSD1306_I2C
 from fifo import Fifo
 from filefifo import Filefifo 
+from src.utils import SSD1306Wrapper
 
 i2c = I2C(1, scl=Pin(15), sda=Pin(14), freq=400000)
 oled_width = 128
 oled_height = 64
-oled = SSD1306_I2C(oled_width, oled_height, i2c)
+oled = SSD1306Wrapper(SSD1306_I2C(oled_width, oled_height, i2c))
 
 class SignalPlotter:
     def __init__(self):
@@ -58,9 +59,13 @@ class SignalPlotter:
     def display_bpm(self, value):
         oled.fill_rect(0, 56, 64, 8, 0) 
 
-        oled.text(f"{"BPM"}:{int(value)}", 0, 56, 1)
+        oled.text(f"BPM:{int(value)}", 0, 56, 1)
 
 
+    def display_hrv(self, rmssd, sdnn):
+        self.display.fill_rect(0, 0, self.width, 10, 0)
+        self.display.text(f"RMSSD:{rmssd:.0f} SD:{sdnn:.0f}", 0, 1, 1)
+
     def display_countdown(self, seconds):
         self.display.fill_rect(80, 56, 48, 8, 0)  
         self.display.text(f"{seconds}s", 90, 56, 1)  
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import binascii
+from array import array
+from time import time
+
+# Kubios responses on flash, one file per result named after result_key() of the request it answers.
+# The index lists the keys with their file sizes, least recently used first.
+CACHE_DIR = "kubios"
+INDEX_FILE = CACHE_DIR + "/index"
+MAX_ENTRIES = 32
+MAX_BYTES = 32768
+
+
+def result_key(ibi, analysis="readiness"):
+    """Same IBI series and analysis type, same key"""
+    digest = hashlib.sha256(analysis.encode())
+    digest.update(array('H', ibi))
+    return binascii.hexlify(digest.digest()[:8]).decode()
+
+
+class KubiosCache:
+    """Kubios results by result_key(), kept for repeated requests and for browsing without a connection.
+    get() makes an entry the most recently used, put() drops the least recently used ones while there are
+    more than max_entries or they take more than max_bytes."""
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.index = []  # [key, size]
+        self.load()
+
+    def path(self, key):
+        return "%s/%s.json" % (CACHE_DIR, key)
+
+    def load(self):
+        if CACHE_DIR not in os.listdir():
+            os.mkdir(CACHE_DIR)
+        files = [name[:-5] for name in os.listdir(CACHE_DIR) if name.endswith(".json")]
+        try:
+            with open(INDEX_FILE) as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = []
+        index = [entry for entry in index if entry[0] in files]
+        known = [entry[0] for entry in index]
+        # Results the index lost to a power cut count as the least recently used
+        self.index = [[key, os.stat(self.path(key))[6]] for key in files if key not in known] + index
+
+    def save_index(self):
+        with open(INDEX_FILE, "w") as file:
+            json.dump(self.index, file)
+
+    def find(self, key):
+        for i, entry in enumerate(self.index):
+            if entry[0] == key:
+                return i
+        return -1
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        """Most recently used first"""
+        return [entry[0] for entry in reversed(self.index)]
+
+    def entry(self, key):
+        """The stored {"time", "type", "beats", "response"} for key, None if there is none.
+        Reading an entry this way does not count as a use."""
+        try:
+            with open(self.path(key)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key):
+        """The cached response, None on a miss"""
+        i = self.find(key)
+        if i < 0:
+            return None
+        entry = self.entry(key)
+        if entry is None:
+            self.index.pop(i)
+            self.save_index()
+            return None
+        if i != len(self.index) - 1:
+            self.index.append(self.index.pop(i))
+            self.save_index()
+        return entry["response"]
+
+    def put(self, key, response, analysis, beats):
+        data = json.dumps({"time": time(), "type": analysis, "beats": beats, "response": response})
+        if len(data) > self.max_bytes:
+            return
+        i = self.find(key)
+        if i >= 0:
+            self.index.pop(i)
+        with open(self.path(key), "w") as file:
+            file.write(data)
+        self.index.append([key, len(data)])
+        total = sum(entry[1] for entry in self.index)
+        while len(self.index) > self.max_entries or total > self.max_bytes:
+            old, size = self.index.pop(0)
+            total -= size
+            os.remove(self.path(old))
+        self.save_index()
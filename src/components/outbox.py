@@ -0,0 +1,141 @@
+import os
+import struct
+
+# Messages waiting for the broker, oldest first: each a header and the topic and payload bytes.
+# The read position lives in its own small file, so sending a batch never rewrites the queue.
+OUTBOX_DIR = "outbox"
+QUEUE_FILE = OUTBOX_DIR + "/queue.bin"
+HEAD_FILE = OUTBOX_DIR + "/head"
+ENTRY = "<BH"  # topic length, payload length
+ENTRY_SIZE = struct.calcsize(ENTRY)
+MAX_BYTES = 16384  # about 60 hr-data results
+COMPACT_BYTES = 4096
+
+
+class Outbox:
+    """Durable FIFO of (topic, payload) messages on flash.
+    put() appends, peek() reads from the head and commit() moves the head past what was sent, so a
+    power loss mid-batch resends at most that batch. When the queue is over max_bytes the oldest
+    messages are dropped (counted in dropped). Sent messages are cut off the front once they add up to
+    COMPACT_BYTES, and both files go away when everything has been sent."""
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.head = 0
+        self.end = 0
+        self.count = 0
+        self.dropped = 0
+        self.load()
+
+    def load(self):
+        if OUTBOX_DIR not in os.listdir():
+            os.mkdir(OUTBOX_DIR)
+        files = os.listdir(OUTBOX_DIR)
+        if "queue.bin" not in files and "queue.bin.tmp" in files:
+            # compact() was cut off before its rename
+            os.rename(QUEUE_FILE + ".tmp", QUEUE_FILE)
+            files = os.listdir(OUTBOX_DIR)
+        if "queue.bin" not in files:
+            return
+        if "head" in files:
+            with open(HEAD_FILE, "rb") as file:
+                raw = file.read(4)
+            if len(raw) == 4:
+                self.head = struct.unpack("<I", raw)[0]
+        size = os.stat(QUEUE_FILE)[6]
+        # Count whole entries, an append cut short by a power loss ends the queue
+        self.end = min(self.head, size)
+        self.head = self.end
+        for _, _, end in self.entries(self.head, None):
+            self.end = end
+            self.count += 1
+        if self.end != size:
+            self.compact()
+
+    def entries(self, start, limit):
+        """Yields (topic, payload, end offset) from start, at most limit of them (None for all)"""
+        try:
+            file = open(QUEUE_FILE, "rb")
+        except OSError:
+            return
+        with file:
+            file.seek(start)
+            offset = start
+            while limit is None or limit > 0:
+                header = file.read(ENTRY_SIZE)
+                if len(header) < ENTRY_SIZE:
+                    return
+                topic_len, payload_len = struct.unpack(ENTRY, header)
+                topic = file.read(topic_len)
+                payload = file.read(payload_len)
+                if len(topic) < topic_len or len(payload) < payload_len:
+                    return
+                offset += ENTRY_SIZE + topic_len + payload_len
+                yield topic.decode(), payload, offset
+                if limit is not None:
+                    limit -= 1
+
+    def pending(self):
+        return self.count
+
+    def put(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode()
+        size = ENTRY_SIZE + len(topic) + len(payload)
+        if size > self.max_bytes:
+            raise ValueError("message larger than the outbox")
+        while self.count and self.end - self.head + size > self.max_bytes:
+            self.commit(1)
+            self.dropped += 1
+        with open(QUEUE_FILE, "ab") as file:
+            file.write(struct.pack(ENTRY, len(topic), len(payload)))
+            file.write(topic)
+            file.write(payload)
+        self.end += size
+        self.count += 1
+
+    def peek(self, limit):
+        """Up to limit of the oldest messages as (topic, payload, position) for commit()"""
+        return list(self.entries(self.head, limit))
+
+    def commit(self, sent, position=None):
+        """The oldest sent messages reached the broker. position is the last one's from peek(), saves a read."""
+        if not sent:
+            return
+        if position is None:
+            for _, _, position in self.entries(self.head, sent):
+                pass
+        self.head = position
+        self.count -= sent
+        if not self.count:
+            self.clear()
+        elif self.head >= COMPACT_BYTES:
+            self.compact()
+        else:
+            with open(HEAD_FILE, "wb") as file:
+                file.write(struct.pack("<I", self.head))
+
+    def compact(self):
+        """Rewrites the queue without the sent messages (and without a torn last append)"""
+        temp = QUEUE_FILE + ".tmp"
+        with open(temp, "wb") as out:
+            for topic, payload, _ in self.entries(self.head, self.count):
+                topic = topic.encode()
+                out.write(struct.pack(ENTRY, len(topic), len(payload)))
+                out.write(topic)
+                out.write(payload)
+        self.end -= self.head
+        self.head = 0
+        # Head first: if power fails in between, the old queue with head 0 only resends what was sent
+        with open(HEAD_FILE, "wb") as file:
+            file.write(struct.pack("<I", 0))
+        os.remove(QUEUE_FILE)
+        os.rename(temp, QUEUE_FILE)
+
+    def clear(self):
+        for name in ("queue.bin", "head"):
+            if name in os.listdir(OUTBOX_DIR):
+                os.remove(OUTBOX_DIR + "/" + name)
+        self.head = 0
+        self.end = 0
+        self.count = 0
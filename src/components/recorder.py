@@ -0,0 +1,92 @@
+import os
+import struct
+from array import array
+
+# .ppg file: header, then raw little endian uint16 sensor values (read_u16() >> 2) at the sampling rate
+MAGIC = b"PPG1"
+HEADER = "<4sHB"  # magic, sampling rate, left shift back to read_u16() units
+RECORDING_DIR = "ppg"
+BLOCK_SAMPLES = 1024  # 2 KB per flash write, about 4 s of signal
+KEEP = 3
+
+
+class TraceRecorder:
+    """Streams the raw sensor samples of a measurement to flash.
+    Samples are copied into one of two preallocated blocks; a full block is only written out by flush(),
+    which Detect_peaks calls after it has drained the fifo, so flash writes never happen mid-chunk and
+    only once every few seconds. Files go to ppg/, only the newest KEEP are kept."""
+    # Toggled from the settings menu, measurements started while it is on get recorded
+    enabled = False
+
+    def __init__(self, sampling_rate, block_samples=BLOCK_SAMPLES):
+        self.sampling_rate = sampling_rate
+        self.block_samples = block_samples
+        self.blocks = [array('H', [0] * block_samples) for _ in range(2)]
+        self.views = [memoryview(block) for block in self.blocks]
+        self.file = None
+        self.file_name = None
+        self.reset()
+
+    def reset(self):
+        self.active = 0
+        self.fill = 0
+        self.pending = None
+        self.last = 0
+        self.samples = 0
+
+    def start(self):
+        if RECORDING_DIR not in os.listdir():
+            os.mkdir(RECORDING_DIR)
+        numbers = sorted(int(name[:-4]) for name in os.listdir(RECORDING_DIR) if name.endswith(".ppg"))
+        while len(numbers) >= KEEP:
+            os.remove("%s/%d.ppg" % (RECORDING_DIR, numbers.pop(0)))
+        self.file_name = "%s/%d.ppg" % (RECORDING_DIR, numbers[-1] + 1 if numbers else 1)
+        self.file = open(self.file_name, "wb")
+        self.file.write(struct.pack(HEADER, MAGIC, self.sampling_rate, 2))
+        self.reset()
+
+    def write(self, view, n):
+        """Copy n samples from view (a memoryview of an array('H'))"""
+        i = 0
+        while i < n:
+            take = min(n - i, self.block_samples - self.fill)
+            self.views[self.active][self.fill:self.fill + take] = view[i:i + take]
+            self.fill += take
+            i += take
+            if self.fill == self.block_samples:
+                self.swap()
+        self.last = view[n - 1]
+        self.samples += n
+
+    def pad(self, n):
+        """Stand-ins for samples the fifo dropped, so the recording keeps its timing"""
+        block = self.blocks[self.active]
+        for _ in range(n):
+            block[self.fill] = self.last
+            self.fill += 1
+            if self.fill == self.block_samples:
+                self.swap()
+                block = self.blocks[self.active]
+        self.samples += n
+
+    def swap(self):
+        if self.pending is not None:
+            # flush() did not get to run since the last block filled up
+            self.flush()
+        self.pending = self.active
+        self.active ^= 1
+        self.fill = 0
+
+    def flush(self):
+        if self.pending is not None and self.file:
+            self.file.write(self.blocks[self.pending])
+        self.pending = None
+
+    def stop(self):
+        if not self.file:
+            return
+        self.flush()
+        if self.fill:
+            self.file.write(self.views[self.active][:self.fill])
+        self.file.close()
+        self.file = None
@@ -0,0 +1,66 @@
+# Compact wire format for Kubios RRI requests, the gateway turns it back into the JSON request.
+#   version byte, request id (varint), analysis type (length byte + ASCII), IBI count (varint),
+#   then every IBI as the zigzag varint of its difference to the previous one (the first to 0).
+# Consecutive IBIs rarely differ by more than 63 ms, so most take one byte instead of about five in JSON.
+FORMAT = "rri-delta-v1"
+VERSION = 1
+
+
+def put_varint(buf, pos, value):
+    while value > 0x7F:
+        buf[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    buf[pos] = value
+    return pos + 1
+
+
+def get_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_rri(request_id, ibi, analysis="readiness"):
+    """Returns the request as a memoryview into one preallocated buffer, nothing else is built"""
+    analysis = analysis.encode()
+    # Room for a 64 bit id and count; 3 bytes hold any IBI difference up to +-1048 s
+    buf = bytearray(16 + len(analysis) + 3 * len(ibi))
+    buf[0] = VERSION
+    pos = put_varint(buf, 1, request_id)
+    buf[pos] = len(analysis)
+    pos += 1
+    buf[pos:pos + len(analysis)] = analysis
+    pos += len(analysis)
+    pos = put_varint(buf, pos, len(ibi))
+    prev = 0
+    for value in ibi:
+        delta = value - prev
+        prev = value
+        pos = put_varint(buf, pos, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+    return memoryview(buf)[:pos]
+
+
+def decode_rri(payload):
+    """The Kubios request dict for an encode_rri() payload"""
+    if payload[0] != VERSION:
+        raise ValueError("unknown RRI payload version %d" % payload[0])
+    request_id, pos = get_varint(payload, 1)
+    length = payload[pos]
+    pos += 1
+    analysis = bytes(payload[pos:pos + length]).decode()
+    pos += length
+    count, pos = get_varint(payload, pos)
+    ibi = []
+    value = 0
+    for _ in range(count):
+        zigzag, pos = get_varint(payload, pos)
+        value += zigzag >> 1 if not zigzag & 1 else -((zigzag + 1) >> 1)
+        ibi.append(value)
+    return {"id": request_id, "type": "RRI", "data": ibi, "analysis": {"type": analysis}}
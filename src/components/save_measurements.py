@@ -1,41 +1,316 @@
 import os
+import struct
 import ujson
+import binascii
+import uasyncio
+
+# Each history segment: header followed by fixed size records, so appends are O(1) and a record is one seek away
+HISTORY_DIR = "history"
+MIGRATION_FILE = HISTORY_DIR + "/migration"  # legacy import progress, so a reboot resumes where it stopped
+SEGMENT_RECORDS = 64
+SEGMENTS = 8
+MAGIC = b"HRVL"
+VERSION = 1
+HEADER = "<4sHH"  # magic, version, record size
+HEADER_SIZE = struct.calcsize(HEADER)
+RECORD = "<I8s8f"  # time, device id, FIELDS
+RECORD_SIZE = struct.calcsize(RECORD)
+FIELDS = ("Mean HR", "PPI (ms)", "RMSSD", "SDNN", "pNN50", "SD1", "SD2", "DFA a1")
+
+
+class PagedHistory:
+    """Sequence over the stored measurements that loads them a page at a time.
+    Only max_pages pages stay in memory, least recently used goes first. Records are never rewritten,
+    so refresh() only has to pick up the new length and drop a page that was still filling,
+    unless the oldest segment was rotated out and every index moved."""
+    def __init__(self, measurements, page_size=4, max_pages=4):
+        self.measurements = measurements
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = {}
+        self.recent = []
+        self.length = 0
+        self.oldest = None
+        self.refresh()
+
+    def refresh(self):
+        self.length = self.measurements.count()
+        oldest = self.measurements.oldest()
+        if oldest != self.oldest:
+            self.pages = {}
+            self.recent = []
+            self.oldest = oldest
+        for page in list(self.pages):
+            if len(self.pages[page]) < self.page_size or page * self.page_size >= self.length:
+                self.drop(page)
+
+    def drop(self, page):
+        del self.pages[page]
+        self.recent.remove(page)
+
+    def load(self, page):
+        if page in self.pages:
+            self.recent.remove(page)
+        else:
+            start = page * self.page_size
+            self.pages[page] = self.measurements.get_range(start, min(self.page_size, self.length - start))
+            if len(self.recent) >= self.max_pages:
+                self.drop(self.recent[0])
+        self.recent.append(page)
+        return self.pages[page]
+
+    def prefetch(self, first, visible):
+        """Make sure the pages for first .. first + visible and one row either side are loaded"""
+        start = max(0, first - 1)
+        end = min(self.length, first + visible + 1)
+        for page in range(start // self.page_size, (end - 1) // self.page_size + 1):
+            if page not in self.pages:
+                self.load(page)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("measurement index out of range")
+        return self.load(index // self.page_size)[index % self.page_size]
+
 
 class Measurements():
-    def __init__(self):
-        self.file_name = "data.json"
+    """Measurement history in segment files under history/, each a header and up to segment_records records.
+    Saves append to the newest segment; once it is full maintain() starts the next one in the background and
+    deletes the oldest beyond the segments limit, so the history keeps between (segments - 1) * segment_records
+    and segments * segment_records measurements and no file is rewritten. New segment files land on fresh
+    flash blocks, which spreads the wear."""
+    def __init__(self, segment_records=SEGMENT_RECORDS, segments=SEGMENTS):
+        self.dir_name = HISTORY_DIR
+        self.legacy_file_names = ("data.bin", "data.json")
+        self.segment_records = segment_records
+        self.segments = segments
+        self.migrating = None
         self.current_dir = os.getcwd()
         self.dummy_data = {"time": 1609459392, "Mean HR": 74.86, "RMSSD": 74, "PPI (ms)": 801.54, "id": "e661640843963727", "SDNN": 55.6}
         self.initialize()
 
     def initialize(self):
-        if self.file_name not in os.listdir():
-            with open(self.file_name, "w") as file:
-                ujson.dump([self.dummy_data], file)
-        with open(self.file_name, "r") as file:
-            try:
-                data = ujson.load(file)
-                if not isinstance(data, list):
-                    data = []
-            except: 
-                data.append(self.dummy_data)
-                with open(self.file_name, "w") as file:
-                    ujson.dump(data, file)
-                
+        files = os.listdir()
+        if self.dir_name not in files:
+            os.mkdir(self.dir_name)
+        legacy = any(name in files for name in self.legacy_file_names)
+        if not legacy and MIGRATION_FILE[len(self.dir_name) + 1:] in os.listdir(self.dir_name):
+            # The power went out between the last legacy file's rename and removing its progress
+            os.remove(MIGRATION_FILE)
+        if not self.segment_ids():
+            self.create_segment(1)
+            if not legacy:
+                self.add_to_file(self.dummy_data)
+
+    def segment_ids(self):
+        # Only names segment_path() gives, a copied or leftover file in history/ is not a segment
+        return sorted(int(name[:8]) for name in os.listdir(self.dir_name)
+                      if len(name) == 12 and name.endswith(".bin") and name[:8].isdigit())
+
+    def segment_path(self, segment):
+        return "%s/%08d.bin" % (self.dir_name, segment)
+
+    def create_segment(self, segment):
+        with open(self.segment_path(segment), "wb") as file:
+            file.write(struct.pack(HEADER, MAGIC, VERSION, RECORD_SIZE))
+
+    def segment_count(self, segment):
+        # A record cut short by a power loss is not counted, the next append overwrites it
+        return min(self.segment_records, (os.stat(self.segment_path(segment))[6] - HEADER_SIZE) // RECORD_SIZE)
+
+    def oldest(self):
+        return self.segment_ids()[0]
+
+    def rotate(self, ids):
+        """Start the next segment and drop the oldest ones beyond the limit, returns the new segment"""
+        segment = ids[-1] + 1
+        self.create_segment(segment)
+        ids.append(segment)
+        while len(ids) > self.segments:
+            os.remove(self.segment_path(ids.pop(0)))
+        return segment
+
+    def pack(self, measurement):
+        return struct.pack(RECORD, int(measurement["time"]), binascii.unhexlify(measurement["id"]),
+                           *[float(measurement.get(field, 0)) for field in FIELDS])
+
+    def unpack(self, raw):
+        values = struct.unpack(RECORD, raw)
+        measurement = {"time": values[0], "id": binascii.hexlify(values[1]).decode()}
+        for field, value in zip(FIELDS, values[2:]):
+            measurement[field] = round(value, 2)
+        return measurement
+
+    def count(self):
+        return sum(self.segment_count(segment) for segment in self.segment_ids())
 
     def add_to_file(self, measurement):
-        with open(self.file_name, "r") as file:
-            data = ujson.load(file)
-        
-        new_data = measurement
-        data.append(new_data)
-
-        with open(self.file_name, "w") as file:
-            ujson.dump(data, file)
-    
+        # Legacy measurements are older than anything saved now, they go in first
+        while self.compact():
+            pass
+        self.append(measurement)
+
+    def append(self, measurement):
+        record = self.pack(measurement)
+        ids = self.segment_ids()
+        segment = ids[-1]
+        count = self.segment_count(segment)
+        if count >= self.segment_records:
+            # maintain() normally did this already, right after the previous save filled the segment
+            segment = self.rotate(ids)
+            count = 0
+        with open(self.segment_path(segment), "r+b") as file:
+            file.seek(HEADER_SIZE + count * RECORD_SIZE)
+            file.write(record)
+
+    def locate(self, index):
+        """Segment and position within it of the record at index (0 is the oldest)"""
+        for segment in self.segment_ids():
+            count = self.segment_count(segment)
+            if index < count:
+                return segment, index, count
+            index -= count
+        raise IndexError("measurement index out of range")
+
+    def get(self, index):
+        if index < 0:
+            raise IndexError("measurement index out of range")
+        segment, position, _ = self.locate(index)
+        with open(self.segment_path(segment), "rb") as file:
+            file.seek(HEADER_SIZE + position * RECORD_SIZE)
+            return self.unpack(file.read(RECORD_SIZE))
+
+    def get_range(self, start, count):
+        """count consecutive records from start, one seek and read per segment touched"""
+        records = []
+        while count > 0:
+            try:
+                segment, position, segment_count = self.locate(start)
+            except IndexError:
+                break
+            n = min(count, segment_count - position)
+            with open(self.segment_path(segment), "rb") as file:
+                file.seek(HEADER_SIZE + position * RECORD_SIZE)
+                raw = file.read(n * RECORD_SIZE)
+            for i in range(0, len(raw) - RECORD_SIZE + 1, RECORD_SIZE):
+                records.append(self.unpack(raw[i:i + RECORD_SIZE]))
+            start += n
+            count -= n
+        return records
+
+    def records(self):
+        return PagedHistory(self)
+
     def get_from_file(self):
-        with open(self.file_name, "r") as file:
-            print("reading file")
-            data = ujson.load(file)
-        return data
+        """Every measurement as a list of dicts. Prefer records() or get(), they don't load the whole history."""
+        return self.get_range(0, self.count())
+
+    def legacy_records(self, file_name):
+        """Measurements from the files older versions wrote: data.json, or data.bin (one log without segments)"""
+        if file_name.endswith(".json"):
+            try:
+                with open(file_name, "r") as file:
+                    data = ujson.load(file)
+            except (OSError, ValueError):
+                data = []
+            for measurement in data if isinstance(data, list) else []:
+                yield measurement
+            return
+        with open(file_name, "rb") as file:
+            header = file.read(HEADER_SIZE)
+            if len(header) != HEADER_SIZE or struct.unpack(HEADER, header) != (MAGIC, VERSION, RECORD_SIZE):
+                return
+            while True:
+                raw = file.read(RECORD_SIZE)
+                if len(raw) < RECORD_SIZE:
+                    return
+                yield self.unpack(raw)
+
+    def end(self):
+        """(newest segment, records in it), where the next record goes"""
+        segment = self.segment_ids()[-1]
+        return segment, self.segment_count(segment)
+
+    def appended_since(self, end):
+        segment, count = end
+        return sum(self.segment_count(s) - (count if s == segment else 0)
+                   for s in self.segment_ids() if s >= segment)
+
+    def save_progress(self):
+        name, _, consumed = self.migrating
+        with open(MIGRATION_FILE, "w") as file:
+            ujson.dump([name, consumed, self.end()], file)
+
+    def start_migration(self, name):
+        """Reads name from where the saved progress says the import stopped. Records imported after that
+        progress was written are found by what was appended to the history since, and skipped too."""
+        records = self.legacy_records(name)
+        consumed = 0
+        try:
+            with open(MIGRATION_FILE) as file:
+                saved_name, saved_consumed, saved_end = ujson.load(file)
+            if saved_name == name:
+                consumed = saved_consumed
+                extra = self.appended_since(saved_end)
+                for _ in range(consumed):
+                    next(records)
+                while extra > 0:
+                    measurement = next(records)
+                    consumed += 1
+                    try:
+                        self.pack(measurement)
+                        extra -= 1
+                    except (KeyError, TypeError, ValueError):
+                        pass
+        except (OSError, ValueError, TypeError):
+            consumed = 0
+            records = self.legacy_records(name)
+        except StopIteration:
+            pass
+        self.migrating = [name, records, consumed]
+        self.save_progress()
+
+    def compact(self, limit=16):
+        """One bounded step of background work: imports up to limit legacy measurements, starts the next
+        segment when the newest is full. Returns True while there is more to do."""
+        if self.migrating is None:
+            files = os.listdir()
+            for name in self.legacy_file_names:
+                if name in files:
+                    self.start_migration(name)
+                    break
+        if self.migrating is not None:
+            name, records, _ = self.migrating
+            for _ in range(limit):
+                try:
+                    measurement = next(records)
+                except StopIteration:
+                    # Only the rename ends the migration, the progress file is just for resuming it
+                    os.rename(name, name + ".bak")
+                    os.remove(MIGRATION_FILE)
+                    self.migrating = None
+                    return True
+                self.migrating[2] += 1
+                try:
+                    self.append(measurement)
+                except (KeyError, TypeError, ValueError):
+                    print("skipping invalid measurement", measurement)
+            self.save_progress()
+            return True
+
+        ids = self.segment_ids()
+        if len(ids) > self.segments or self.segment_count(ids[-1]) >= self.segment_records:
+            self.rotate(ids)
+        return False
 
+    async def maintain(self, interval=2):
+        while True:
+            if self.compact():
+                await uasyncio.sleep_ms(10)
+            else:
+                await uasyncio.sleep(interval)
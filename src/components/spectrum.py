@@ -0,0 +1,214 @@
+import math
+from array import array
+import micropython
+
+RESAMPLE_HZ = 4
+FFT_SIZE = 1024  # 256 s of resampled signal per Welch segment
+MAX_SECONDS = 300  # longer recordings are analysed over their last 5 minutes
+MIN_SECONDS = 60
+
+BANDS = (
+    ("VLF", 0.0033, 0.04),
+    ("LF", 0.04, 0.15),
+    ("HF", 0.15, 0.4),
+)
+
+
+class SpectralAnalysis:
+    """Frequency domain HRV from an IBI series.
+    The beats are linearly resampled to 4 Hz, linearly detrended and split into 50 % overlapping Hann windowed
+    segments (Welch). Each segment goes through a real FFT done as a half size complex radix-2 FFT.
+    Twiddles, bit reversal order and the window are computed once, all buffers are preallocated
+    (about 30 KB in total) so repeated analyses don't allocate."""
+    def __init__(self, size=FFT_SIZE, fs=RESAMPLE_HZ, max_seconds=MAX_SECONDS):
+        self.size = size
+        self.fs = fs
+        half = size // 2
+        self.half = half
+        self.cos = array('f', [math.cos(2 * math.pi * k / size) for k in range(half + 1)])
+        self.sin = array('f', [math.sin(2 * math.pi * k / size) for k in range(half + 1)])
+        self.window = array('f', [0.5 - 0.5 * math.cos(2 * math.pi * n / (size - 1)) for n in range(size)])
+
+        bits = 0
+        while (1 << bits) < half:
+            bits += 1
+        self.rev = array('H', [0] * half)
+        for i in range(half):
+            r = 0
+            for b in range(bits):
+                if i & (1 << b):
+                    r |= 1 << (bits - 1 - b)
+            self.rev[i] = r
+
+        self.re = array('f', [0] * half)
+        self.im = array('f', [0] * half)
+        self.psd = array('f', [0] * (half + 1))
+        self.series = array('f', [0] * (max_seconds * fs))
+
+    def resample(self, ibi):
+        """Fills self.series with the IBI curve sampled at fs, returns the sample count"""
+        step = 1000 / self.fs
+        capacity = len(self.series)
+        total = 0
+        for value in ibi:
+            total += value
+        # Only the most recent capacity samples fit, skip beats that end before that
+        start_t = max(ibi[0], total - (capacity - 1) * step)
+
+        n = 0
+        t = start_t
+        beat_t = 0
+        prev_t = None
+        prev_v = 0
+        for value in ibi:
+            beat_t += value
+            if prev_t is None:
+                prev_t = beat_t
+                prev_v = value
+                continue
+            slope = (value - prev_v) / (beat_t - prev_t)
+            while t <= beat_t and n < capacity:
+                if t >= prev_t:
+                    self.series[n] = prev_v + slope * (t - prev_t)
+                    n += 1
+                t += step
+            prev_t = beat_t
+            prev_v = value
+        return n
+
+    def detrend(self, n):
+        """Removes the least squares line from the first n samples"""
+        series = self.series
+        mean_x = (n - 1) / 2
+        sum_y = 0.0
+        sum_xy = 0.0
+        for i in range(n):
+            sum_y += series[i]
+            sum_xy += (i - mean_x) * series[i]
+        mean_y = sum_y / n
+        var_x = n * (n * n - 1) / 12
+        slope = sum_xy / var_x
+        for i in range(n):
+            series[i] -= mean_y + slope * (i - mean_x)
+
+    @micropython.native
+    def fft(self):
+        """In place radix-2 FFT of self.re/self.im"""
+        re = self.re
+        im = self.im
+        rev = self.rev
+        cos = self.cos
+        sin = self.sin
+        m = self.half
+        for i in range(m):
+            j = rev[i]
+            if j > i:
+                re[i], re[j] = re[j], re[i]
+                im[i], im[j] = im[j], im[i]
+
+        span = 2
+        while span <= m:
+            half = span >> 1
+            step = self.size // span
+            for start in range(0, m, span):
+                k = 0
+                for j in range(start, start + half):
+                    wr = cos[k]
+                    wi = sin[k]
+                    l = j + half
+                    tr = wr * re[l] + wi * im[l]
+                    ti = wr * im[l] - wi * re[l]
+                    re[l] = re[j] - tr
+                    im[l] = im[j] - ti
+                    re[j] += tr
+                    im[j] += ti
+                    k += step
+            span <<= 1
+
+    @micropython.native
+    def add_segment_power(self, offset, length):
+        """Windowed real FFT of series[offset:offset + length] (zero padded), adds |X|^2 to self.psd.
+        Returns the window power sum(w^2) used for scaling."""
+        size = self.size
+        m = self.half
+        series = self.series
+        window = self.window
+        re = self.re
+        im = self.im
+        # Stretch the precomputed window over shorter segments
+        scale = size / length
+        power = 0.0
+        for k in range(m):
+            v = 0.0
+            i = 2 * k
+            if i < length:
+                w = window[int(i * scale)]
+                power += w * w
+                v = series[offset + i] * w
+            re[k] = v
+            v = 0.0
+            i += 1
+            if i < length:
+                w = window[int(i * scale)]
+                power += w * w
+                v = series[offset + i] * w
+            im[k] = v
+
+        self.fft()
+
+        cos = self.cos
+        sin = self.sin
+        psd = self.psd
+        for k in range(m + 1):
+            a = k % m
+            b = (m - k) % m
+            zr = re[a]
+            zi = im[a]
+            cr = re[b]
+            ci = -im[b]
+            er = (zr + cr) * 0.5
+            ei = (zi + ci) * 0.5
+            o_r = (zi - ci) * 0.5
+            o_i = (cr - zr) * 0.5
+            c = cos[k]
+            s = sin[k]
+            xr = er + c * o_r + s * o_i
+            xi = ei + c * o_i - s * o_r
+            psd[k] += xr * xr + xi * xi
+        return power
+
+    def analyse(self, ibi):
+        """Returns band powers in ms^2 and the LF/HF ratio, or None when the recording is too short"""
+        if len(ibi) < 3 or sum(ibi) < MIN_SECONDS * 1000:
+            return None
+        n = self.resample(ibi)
+        self.detrend(n)
+
+        size = self.size
+        psd = self.psd
+        for k in range(len(psd)):
+            psd[k] = 0
+        if n <= size:
+            offsets = [0]
+            length = n
+        else:
+            length = size
+            offsets = list(range(0, n - size + 1, size // 2))
+            if offsets[-1] != n - size:
+                offsets.append(n - size)
+
+        power = 0.0
+        for offset in offsets:
+            power += self.add_segment_power(offset, length)
+
+        # One sided PSD in ms^2/Hz, averaged over segments
+        norm = 1 / (self.fs * power)
+        df = self.fs / size
+        result = {}
+        for name, low, high in BANDS:
+            band = 0.0
+            for k in range(int(low / df) + 1, min(int(high / df), self.half) + 1):
+                band += psd[k]
+            result[name] = round(2 * band * norm * df, 1)
+        result["LF/HF"] = round(result["LF"] / result["HF"], 2) if result["HF"] else 0
+        return result
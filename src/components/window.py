@@ -0,0 +1,79 @@
+from array import array
+
+
+class SlidingWindow:
+    """Fixed-size sample window for the peak detector.
+    Keeps a running sum and monotonic min/max queues of buffer slots so push, min, max and mean are all O(1)
+    instead of rescanning the whole window for every sample."""
+    def __init__(self, size, typecode='H'):
+        self.size = size
+        self.buffer = array(typecode, [0] * size)
+        # Queues hold buffer slot indices, values along the queue are increasing (min) / decreasing (max)
+        self.min_q = array('H', [0] * size)
+        self.max_q = array('H', [0] * size)
+        self.reset()
+
+    def reset(self):
+        self.head = 0
+        self.length = 0
+        self.total = 0
+        self.min_head = 0
+        self.min_len = 0
+        self.max_head = 0
+        self.max_len = 0
+
+    def __len__(self):
+        return self.length
+
+    def full(self):
+        return self.length == self.size
+
+    def push(self, value):
+        size = self.size
+        buf = self.buffer
+        slot = self.head
+
+        if self.length == size:
+            # Oldest sample lives in the slot we are about to overwrite
+            self.total -= buf[slot]
+            if self.min_q[self.min_head] == slot:
+                self.min_head = (self.min_head + 1) % size
+                self.min_len -= 1
+            if self.max_q[self.max_head] == slot:
+                self.max_head = (self.max_head + 1) % size
+                self.max_len -= 1
+        else:
+            self.length += 1
+
+        buf[slot] = value
+        self.total += value
+
+        q = self.min_q
+        n = self.min_len
+        while n and buf[q[(self.min_head + n - 1) % size]] >= value:
+            n -= 1
+        q[(self.min_head + n) % size] = slot
+        self.min_len = n + 1
+
+        q = self.max_q
+        n = self.max_len
+        while n and buf[q[(self.max_head + n - 1) % size]] <= value:
+            n -= 1
+        q[(self.max_head + n) % size] = slot
+        self.max_len = n + 1
+
+        slot += 1
+        self.head = 0 if slot == size else slot
+
+    def oldest(self):
+        """Equivalent of window[0] on the old list based buffer"""
+        return self.buffer[self.head if self.length == self.size else 0]
+
+    def min(self):
+        return self.buffer[self.min_q[self.min_head]]
+
+    def max(self):
+        return self.buffer[self.max_q[self.max_head]]
+
+    def mean(self):
+        return self.total // self.length
@@ -1,14 +1,18 @@
-from src.components.save_measurements import Measurements
-from src.bitmaps import wifi, sig_low, sig_mid, sig_high, measure_hr, hrv_analysis, history, settings, kubios
-import framebuf
+from src.assets import icon, icon_width, storage
 import uasyncio
-from src.components.HRV import HRVAnalysis
+from src.components.HRV import HRVAnalysis, HRVAccumulator
 from src.components.HR import Detect_peaks
+from src.components.recorder import TraceRecorder
 from time import ticks_ms, ticks_diff, time, localtime
 from machine import Pin
 from src.wifi import PicoConnection
 import json
 
+# How long wait_input() waits on the encoder before checking the view state (WiFi status) again
+STATE_CHECK_MS = 200
+SIGNAL_CHECK_MS = 5000
+SIGNAL_ICONS = {"Great": "sig_high", "Mid": "sig_mid", "Low": "sig_low"}
+
 class BaseMenu:
     def __init__(self, oled, pico_conn: PicoConnection, items = []):
         self.oled = oled
@@ -22,15 +26,58 @@ class BaseMenu:
         self.spacing = 15
         self.scroll_offset = 0
         self.max_visible_items = 4
-        self.wifi = framebuf.FrameBuffer(
-            bytearray(wifi), 15, 12, framebuf.MONO_HLSB)
-        self.signal_strength_bitmaps = {
-            "Great": framebuf.FrameBuffer(bytearray(sig_high), 19, 14, framebuf.MONO_HLSB),
-            "Mid": framebuf.FrameBuffer(bytearray(sig_mid), 19, 14, framebuf.MONO_HLSB),
-            "Low": framebuf.FrameBuffer(bytearray(sig_low), 18, 14, framebuf.MONO_HLSB)
-        }
-        self.save = Measurements()
+        # Icons and the history are shared by all menus, see src/assets.py
+        self.wifi = icon("wifi")
+        self.save = storage()
+        self.last_view = None
+        self.signal = "Great"
+        self.signal_time = None
+
+
+    def view_state(self):
+        """Everything display() depends on. render() redraws only when this changes"""
+        return (self.selector_pos_y, self.scroll_offset, self.wifi_conn,
+                self.signal_level() if self.wifi_conn else None)
+
+    def invalidate(self):
+        """Something else drew on the screen, redraw on the next render()"""
+        self.last_view = None
+
+    def render(self):
+        view = self.view_state()
+        if view != self.last_view:
+            self.last_view = view
+            self.display()
 
+    async def wait_input(self, timeout_ms=None):
+        """Waits for an encoder event and returns it: +N/-N steps or 0 for a click. Returns None when the
+        view state changed (WiFi status for example) or timeout_ms passed first, so the caller can render()"""
+        start = ticks_ms()
+        while True:
+            wait = STATE_CHECK_MS
+            if timeout_ms is not None:
+                wait = min(wait, timeout_ms - ticks_diff(ticks_ms(), start))
+                if wait <= 0:
+                    return None
+            data = await self.rot.read(wait)
+            if data is not None:
+                return data
+            if self.view_state() != self.last_view:
+                return None
+
+    def signal_level(self):
+        """Signal strength icon to show, the RSSI is read at most every SIGNAL_CHECK_MS"""
+        now = ticks_ms()
+        if self.signal_time is None or ticks_diff(now, self.signal_time) > SIGNAL_CHECK_MS:
+            self.signal_time = now
+            rssi = self.wlan.status("rssi")
+            if rssi > -60:
+                self.signal = "Great"
+            elif rssi > -70:
+                self.signal = "Mid"
+            else:
+                self.signal = "Low"
+        return self.signal
 
     def select_next(self):
         if self.selector_pos_y < len(self.items) - 1:
@@ -47,12 +94,18 @@ class BaseMenu:
     def select_item(self):
         return self.items[self.selector_pos_y]
 
+    def scroll(self, steps):
+        """Moves the selection by an encoder event's step count"""
+        for _ in range(steps):
+            self.select_next()
+        for _ in range(-steps):
+            self.select_previous()
+
     def disable_rotary(self):
         """Disable rotary encoder interrupts"""
         self.rot.a.irq(None)  
         self.rot.sw.irq(None)  
-        while self.rot.fifo.has_data():
-            self.rot.fifo.get()
+        self.rot.clear()
 
     def enable_rotary(self):
         self.rot.a.irq(handler=self.rot.rotary_handler, trigger=Pin.IRQ_RISING, hard=True)
@@ -86,56 +139,38 @@ class BaseMenu:
     def draw_signal_strength(self, x_coord=103):
         """Draw WiFi signal strength icon"""
         if self.wifi_conn == True:
-            signal_strength = "Great"
-            if self.wifi_conn:
-                rssi = self.wlan.status("rssi")
-                if rssi > -60:
-                    signal_strength = "Great"
-                elif rssi > -70:
-                    signal_strength = "Mid"
-                elif rssi > -90:
-                    signal_strength = "Low"
-                else:
-                    signal_strength = "Low"
-
-            self.oled.blit(self.signal_strength_bitmaps[signal_strength], x_coord, -1)
+            self.oled.blit(icon(SIGNAL_ICONS[self.signal_level()]), x_coord, -1)
 
 class MainMenu(BaseMenu):
     def __init__(self, oled, pico_conn, items, rot):
         super().__init__(oled, pico_conn, items)
         self.rot = rot
         self.max_visible_items = 2
+        # Menu item -> its bitmap in src/bitmaps.py
         self.main_menu_bitmaps = {
-            "MEASURE HR": (framebuf.FrameBuffer(bytearray(measure_hr), 110, 14, framebuf.MONO_HLSB), 110),
-            "HRV ANALYSIS": (framebuf.FrameBuffer(bytearray(hrv_analysis), 117, 17, framebuf.MONO_HLSB), 117),
-            "KUBIOS": (framebuf.FrameBuffer(bytearray(kubios), 77, 17, framebuf.MONO_HLSB), 77),
-            "HISTORY": (framebuf.FrameBuffer(bytearray(history), 79, 12, framebuf.MONO_HLSB), 79),
-            "SETTINGS": (framebuf.FrameBuffer(bytearray(settings), 96, 16, framebuf.MONO_HLSB), 96)
+            "MEASURE HR": "measure_hr",
+            "HRV ANALYSIS": "hrv_analysis",
+            "KUBIOS": "kubios",
+            "HISTORY": "history",
+            "SETTINGS": "settings"
         }
-        self.wifi_icon = framebuf.FrameBuffer(
-            bytearray(wifi), 15, 12, framebuf.MONO_HLSB)
 
         self.first_item_y = 20   
         self.second_item_y = 45 
 
     async def handle_input(self):
         while True:
-            if self.rot.fifo.has_data():
-                data = self.rot.get_last_input()
-                if data == 1:
-                    self.select_next()
-                elif data == -1:
-                    self.select_previous()
-                elif data == 0:
-                    selected_item = self.select_item()
-                    return selected_item
-
-            self.display()
-            await uasyncio.sleep_ms(20)
+            self.render()
+            data = await self.wait_input()
+            if data == 0:
+                selected_item = self.select_item()
+                return selected_item
+            elif data:
+                self.scroll(data)
 
     def display(self):
         self.oled.fill(0)
-        self.oled.blit(self.wifi_icon, 0, -1)
+        self.oled.blit(self.wifi, 0, -1)
         if self.wifi_conn == False:
             self.oled.text("!", 13, 0) 
         self.draw_scroll_indicators()
@@ -151,7 +186,8 @@ class MainMenu(BaseMenu):
             if item not in self.main_menu_bitmaps:
                 continue
 
-            bitmap, width = self.main_menu_bitmaps[item]
+            bitmap = icon(self.main_menu_bitmaps[item])
+            width = icon_width(self.main_menu_bitmaps[item])
 
             x = (125 - width) // 2
             if i == 0:
@@ -187,29 +223,25 @@ class MeasureHRMenu(BaseMenu):
         self.measuring = False
         self.current_hr = 0
         self.last_update = 0
-        self.update_interval = 0 
         self.HR = Detect_peaks()
 
+    def view_state(self):
+        return super().view_state() + (self.measuring,)
+
     async def handle_input(self):
         while True:
-            if self.rot.fifo.has_data():
-                data = self.rot.get_last_input()
-                if data == 0:
-                    if not self.measuring:
-                        self.start_measurement()
-                        self.start_time = ticks_ms()
-                    else:
-                        self.stop_measurement()
-                        self.selector_pos_y = 0
-                        return "MAIN"
-
+            # While measuring, the detection task draws the plot
             if not self.measuring:
-                self.display()
-            else:
-                current_time = ticks_ms()
-                if ticks_diff(current_time, self.last_update) > self.update_interval:
-                    self.current_hr = self.calculate_hr()
-                    self.last_update = current_time
+                self.render()
+            data = await self.wait_input()
+            if data == 0:
+                if not self.measuring:
+                    self.start_measurement()
+                    self.start_time = ticks_ms()
+                else:
+                    self.stop_measurement()
+                    self.selector_pos_y = 0
+                    return "MAIN"
 
     def display(self):
         self.oled.fill(0)
@@ -231,15 +263,11 @@ class MeasureHRMenu(BaseMenu):
         self.measuring = True
         self.current_hr = 0
         self.last_update = ticks_ms()
-        # Initialize sensor and measurement here
+        self.HR.start()
 
     def stop_measurement(self):
         self.measuring = False
-        self.HR.reset()
-        # Cleanup/stop sensor here.
-
-    def calculate_hr(self):
-        self.HR.run()
+        self.HR.stop()
 
 
 class HRVAnalysisMenu(BaseMenu):
@@ -250,10 +278,14 @@ class HRVAnalysisMenu(BaseMenu):
        self.header_height = 15
        self.measuring = False
        self.done_measuring = False
-       self.collection_time = 30000
+       # Turning the knob on the start screen switches to the long mode, which adds the frequency domain
+       self.durations = ((30000, "30s"), (300000, "5 min"))
+       self.duration = 0
+       self.collection_time = self.durations[0][0]
        self.start_time = 0
        self.HR = Detect_peaks()
-       self.HRV = HRVAnalysis()
+       self.live_hrv = HRVAccumulator()
+       self.HR.hrv = self.live_hrv
        self.hrv_results = {
            'PPI (ms)': 0,
            'Mean HR': 0,
@@ -262,72 +294,67 @@ class HRVAnalysisMenu(BaseMenu):
        }
        self.selector_pos_y = 0
 
+   def view_state(self):
+       return super().view_state() + (self.measuring, self.done_measuring, self.duration)
+
    async def handle_input(self):
        while True:
-           if self.rot.fifo.has_data():
-               data = self.rot.get_last_input()
-               if self.measuring:
-                   if data == 0:
-                       self.measuring = False
-                       self.selector_pos_y = 0
-                       self.HR.reset()
-                       return "MAIN"
-               elif self.done_measuring:
-                   if data == 1:
-                       self.select_next()
-                   elif data == -1:
-                       self.select_previous()
-                   elif data == 0:
-                       selected = self.select_item()
-                       if selected == "Measure Again":
-                           self.measuring = True
-                           self.done_measuring = False
-                           self.start_time = ticks_ms()
-                           self.hrv_results = {}
-                       else:
-                           return "MAIN"
-               else:
-                   if data == 0:
-                       # hrv_results always returns true so checking for values necessary 
-                       if not self.measuring and any(v != 0 for v in self.hrv_results.values()):
-                           
-                           self.done_measuring = True
-                       else:
-                           self.measuring = True
-                           self.start_time = ticks_ms()
-                           self.hrv_results = {}
-
-           if not self.measuring:
-               self.display()
+           if self.measuring:
+               # The detection task draws the plot, wake up for a click or the end of the window
+               data = await self.wait_input(self.collection_time - ticks_diff(ticks_ms(), self.start_time))
            else:
-               current_time = ticks_ms()
-               elapsed = ticks_diff(current_time, self.start_time)
-               remaining = max(0, (self.collection_time - elapsed) // 1000)
-               self.HR.run(remaining)
-               if elapsed >= self.collection_time:
-                   ibi_data = self.HR.ibi_values
-                   self.HR.reset()
-                   await self.calculate_hrv(ibi_data)
-                   self.measuring = False
+               self.render()
+               data = await self.wait_input()
 
-   async def calculate_hrv(self, ibi):
-        self.hrv_results = self.HRV.calculate(ibi)
+           if self.measuring:
+               if data == 0:
+                   self.measuring = False
+                   self.selector_pos_y = 0
+                   self.HR.stop()
+                   return "MAIN"
+           elif self.done_measuring:
+               if data:
+                   self.scroll(data)
+               elif data == 0:
+                   selected = self.select_item()
+                   if selected == "Measure Again":
+                       self.done_measuring = False
+                       self.start_measuring()
+                   else:
+                       return "MAIN"
+           else:
+               if data == 0:
+                   # hrv_results always returns true so checking for values necessary 
+                   if not self.measuring and any(v != 0 for v in self.hrv_results.values()):
+                       
+                       self.done_measuring = True
+                   else:
+                       self.start_measuring()
+               elif data and all(v == 0 for v in self.hrv_results.values()):
+                   self.duration = (self.duration + 1) % len(self.durations)
+                   self.collection_time = self.durations[self.duration][0]
+
+           if self.measuring and ticks_diff(ticks_ms(), self.start_time) >= self.collection_time:
+               # Statistics were accumulated beat by beat, take them before stop() clears them.
+               # Only recordings of a minute or more have a frequency domain, shorter ones give None.
+               results = self.live_hrv.result(HRVAnalysis.calculate_frequency(self.HR.ibi_raw))
+               self.HR.stop()
+               self.calculate_hrv(results)
+               self.measuring = False
+               self.invalidate()
+
+   def start_measuring(self):
+       self.measuring = True
+       self.start_time = ticks_ms()
+       self.hrv_results = {}
+       self.HR.start(self.collection_time)
+
+   def calculate_hrv(self, results):
+        self.hrv_results = results
         self.save.add_to_file(self.hrv_results)
-        if self.wlan.isconnected():
-            self.disable_rotary()
-            self.oled.fill(0)
-            self.oled.text("Connecting to", 0, 20, 1)
-            self.oled.text("MQTT...", 0, 32, 1)
-            self.oled.show()
-            await self.pico_conn.connect_mqtt()
-            await self.pico_conn.mqtt_publish(self.hrv_results, topic="hr-data")
-            if not self.pico_conn.mqtt_client:
-                self.oled.fill(0)
-                self.oled.text("MQTT connection", 0, 20, 1)
-                self.oled.text("failed!!!", 0, 32, 1)
-                self.oled.show()
-                await uasyncio.sleep(3)
-            self.enable_rotary()
+        # PicoConnection keeps the MQTT session open, publishing doesn't wait for anything.
+        # Offline the result waits in the outbox until the link is back.
+        self.pico_conn.publish_durable(self.hrv_results, topic="hr-data")
 
 
    def display(self):
@@ -340,7 +367,8 @@ class HRVAnalysisMenu(BaseMenu):
        if not self.measuring and all(v == 0 for v in self.hrv_results.values()):
            self.oled.text("Press to start", 0, 25, 1)
            self.oled.text("HRV analysis", 0, 35, 1)
-           self.oled.text("Measuring 30s", 0, 55, 1)
+           self.oled.text("Turn for " + self.durations[self.duration - 1][1], 0, 45, 1)
+           self.oled.text("Measuring " + self.durations[self.duration][1], 0, 55, 1)
        elif self.done_measuring:
            menu_y = 25
            for i, item in enumerate(self.items):
@@ -350,11 +378,20 @@ class HRVAnalysisMenu(BaseMenu):
                    self.oled.rect(0, menu_y + (i * 15) - 2, text_width, 12, 1)
        else:
            y = 20
+           spacing = 11
            display_order = ['Mean HR', 'PPI (ms)', 'RMSSD', 'SDNN']
+           if 'LF/HF' in self.hrv_results:
+               # Long measurement, one more line
+               y = 19
+               spacing = 9
+               display_order.append('LF/HF')
            for key in display_order:
                value = self.hrv_results.get(key, 0)
-               self.oled.text(f"{key}: {value:.0f}", 0, y, 1)
-               y += 11
+               if key == 'LF/HF':
+                   self.oled.text(f"{key}: {value:.2f}", 0, y, 1)
+               else:
+                   self.oled.text(f"{key}: {value:.0f}", 0, y, 1)
+               y += spacing
 
        self.oled.show()
 
@@ -366,36 +403,36 @@ class HistoryMenu(BaseMenu):
         self.max_visible_items = 3
         self.header_height = 15
         self.selected_measurement = None
-        self.HRV_history = self.save.get_from_file()
+        self.HRV_history = self.save.records()
+
+    def view_state(self):
+        return super().view_state() + (self.selected_measurement, len(self.HRV_history))
 
     async def handle_input(self):
-        self.HRV_history = self.save.get_from_file()
+        # Only the length and the newest page can have changed since the menu was last open
+        self.HRV_history.refresh()
         while True:
-            if self.rot.fifo.has_data():
-                data = self.rot.get_last_input()
-                if self.selected_measurement is not None:
-                    if data == 0:
-                        self.selected_measurement = None
-                else:
-                    if data == 1:
-                        if self.selector_pos_y < len(self.HRV_history):
-                            self.select_next()
-                    elif data == -1:
-                        self.select_previous()
-                    elif data == 0:
-                        # Back button selected
-                        if self.selector_pos_y >= len(self.HRV_history):
-                            selected_item = self.items[self.selector_pos_y -
-                                                       len(self.HRV_history)]
-                            if selected_item == "Back":
-                                self.selector_pos_y = 0
-                                self.scroll_offset = 0
-                                return "MAIN"
-                        else:
-                            self.selected_measurement = self.HRV_history[self.selector_pos_y]
-
-            self.display()
-            await uasyncio.sleep_ms(20)
+            self.render()
+            data = await self.wait_input()
+            if self.selected_measurement is not None:
+                if data == 0:
+                    self.selected_measurement = None
+            else:
+                if data:
+                    # A fast spin arrives as one event, only the pages around where it stops get loaded
+                    self.scroll(data)
+                    self.HRV_history.prefetch(self.scroll_offset, self.max_visible_items)
+                elif data == 0:
+                    # Back button selected
+                    if self.selector_pos_y >= len(self.HRV_history):
+                        selected_item = self.items[self.selector_pos_y -
+                                                   len(self.HRV_history)]
+                        if selected_item == "Back":
+                            self.selector_pos_y = 0
+                            self.scroll_offset = 0
+                            return "MAIN"
+                    else:
+                        self.selected_measurement = self.HRV_history[self.selector_pos_y]
 
     def display(self):
         self.oled.fill(0)
@@ -481,45 +518,42 @@ class SettingsMenu(BaseMenu):
         self.brightness = 255  # Default brightness
         self.brightness_step = 51  # 8 steps
 
+    def view_state(self):
+        return super().view_state() + (self.current_submenu, self.brightness, TraceRecorder.enabled, self.wlan_signal)
+
     async def handle_input(self):
         while True:
-            if self.rot.fifo.has_data():
-                data = self.rot.get_last_input()
-                if self.current_submenu == "wifi":
-                    if data == 0:
-                        self.current_submenu = None
-                elif self.current_submenu == "brightness":
-                    if data == 1:
-                        self.brightness = min(
-                            255, self.brightness + self.brightness_step)
-                        self.oled.contrast(self.brightness)
-                    elif data == -1:
-                        self.brightness = max(
-                            0, self.brightness - self.brightness_step)
-                        self.oled.contrast(self.brightness)
-                    elif data == 0:
-                        self.current_submenu = None
-                else:
-                    if data == 1:
-                        self.select_next()
-                    elif data == -1:
-                        self.select_previous()
-                    elif data == 0:
-                        selected_item = self.select_item()
-                        if selected_item == "WiFi":
-                            self.current_submenu = "wifi"
-                        elif selected_item == "Brightness":
-                            self.current_submenu = "brightness"
-                        elif selected_item == "Back":
-                            self.selector_pos_y = 0
-                            return "MAIN"
-
             current_time = ticks_ms()
             if ticks_diff(current_time, self.last_signal_check) > self.signal_check_interval:
                 self.wlan_signal_strength()
                 self.last_signal_check = current_time
-            self.display()
-            await uasyncio.sleep_ms(20)
+            self.render()
+            data = await self.wait_input(self.signal_check_interval)
+
+            if self.current_submenu == "wifi":
+                if data == 0:
+                    self.current_submenu = None
+            elif self.current_submenu == "brightness":
+                if data:
+                    self.brightness = max(0, min(
+                        255, self.brightness + data * self.brightness_step))
+                    self.oled.contrast(self.brightness)
+                elif data == 0:
+                    self.current_submenu = None
+            else:
+                if data:
+                    self.scroll(data)
+                elif data == 0:
+                    selected_item = self.select_item()
+                    if selected_item == "WiFi":
+                        self.current_submenu = "wifi"
+                    elif selected_item == "Brightness":
+                        self.current_submenu = "brightness"
+                    elif selected_item == "Recording":
+                        TraceRecorder.enabled = not TraceRecorder.enabled
+                    elif selected_item == "Back":
+                        self.selector_pos_y = 0
+                        return "MAIN"
 
     def display(self):
         self.oled.fill(0)
@@ -545,6 +579,8 @@ class SettingsMenu(BaseMenu):
                 break
 
             item = self.items[item_index]
+            if item == "Recording":
+                item = "Record: On" if TraceRecorder.enabled else "Record: Off"
             item_position_y = i * self.line_height + self.header_height + 5
             text_width = len(item) * self.font_width + 8
 
@@ -602,7 +638,6 @@ class KubiosMenu(BaseMenu):
         self.rot = rot
         self.header_height = 15
         self.measuring = False
-        self.error_state = False
         self.collection_time = 30000  # 30 sec
         self.start_time = 0
         self.ppi_measurement_array = []
@@ -610,9 +645,7 @@ class KubiosMenu(BaseMenu):
         self.selector_pos_y = 0
         self.scroll_offset = 0
         self.show_results = False
-        self.start_menu_items = ["Measure", "Back"]
         self.results_menu_items = ["Measure Again", "To Main Menu"]
-        self.current_menu = self.start_menu_items
         self.parameters = [
             ('Mean HR', 'mean_hr_bpm', '{:0.0f} BPM'),
             ('Readiness', 'readiness', '{:0.0f}%'),
@@ -624,26 +657,29 @@ class KubiosMenu(BaseMenu):
         self.max_visible_items = 3
         self.line_height = 16
         self.HR = Detect_peaks()
+        self.kubios_response = None
+        # Index into browse_keys while past results from the cache are shown
+        self.browsing = None
+        self.browse_keys = []
 
     def reset_state(self):
         # Reset all kubios menu states to initial values
         self.measuring = False
-        self.error_state = False
         self.awaiting_response = False
         self.selector_pos_y = 0
         self.scroll_offset = 0
         self.show_results = False
-        self.pico_conn.latest_kubios_response = None
+        self.kubios_response = None
         self.ppi_measurement_array = []
         if self.HR:
-            self.HR.reset()
+            self.HR.stop()
 
     def select_next(self):
         if self.show_results:
             if self.selector_pos_y < len(self.results_menu_items) - 1:
                 self.selector_pos_y += 1
-        elif not self.pico_conn.latest_kubios_response:
-            if self.selector_pos_y < len(self.start_menu_items) - 1:
+        elif not self.kubios_response:
+            if self.selector_pos_y < len(self.start_items()) - 1:
                 self.selector_pos_y += 1
         else:
             if self.selector_pos_y < len(self.parameters) - 1:
@@ -655,7 +691,7 @@ class KubiosMenu(BaseMenu):
         if self.show_results:
             if self.selector_pos_y > 0:
                 self.selector_pos_y -= 1
-        elif not self.pico_conn.latest_kubios_response:
+        elif not self.kubios_response:
             if self.selector_pos_y > 0:
                 self.selector_pos_y -= 1
         else:
@@ -664,110 +700,136 @@ class KubiosMenu(BaseMenu):
                 if self.selector_pos_y < self.scroll_offset:
                     self.scroll_offset -= 1
 
+    def start_items(self):
+        """Measuring needs the connection, past results don't. Retry resends a measurement that got no answer."""
+        items = []
+        if self.wlan.isconnected():
+            items.append("Measure")
+            if self.ppi_measurement_array:
+                items.append("Retry")
+        if len(self.pico_conn.kubios_cache):
+            items.append("Results")
+        return items + ["Back"]
+
+    def view_state(self):
+        return super().view_state() + (self.measuring, self.awaiting_response, self.show_results,
+                                       self.kubios_response is not None, self.browsing,
+                                       tuple(self.start_items()))
+
     async def handle_input(self):
         while True:
-            if self.rot.fifo.has_data():
-                data = self.rot.get_last_input()
-                if data == 0:
-                    if self.error_state:
-                        self.error_state = False
-                        return "MAIN"
-                    
-                    if not self.measuring and not self.awaiting_response:
-                        if not self.pico_conn.latest_kubios_response:
-                            # Handle start menu selection
-                            selected = self.start_menu_items[self.selector_pos_y]
-                            if selected == "Measure":
-                                await self.collect_and_send_data()
-                            else:  
-                                return "MAIN"
-                        elif not self.show_results:
-                            self.show_results = True
-                            self.selector_pos_y = 0
-                        else:
-                            # Handle results menu selection
-                            selected = self.results_menu_items[self.selector_pos_y]
-                            if selected == "Measure Again":
-                                self.reset_state()
-                            else:
-                                self.reset_state()
-                                return "MAIN"
-                            
-                elif not self.measuring and not self.awaiting_response:
-                    if data == 1:
-                        self.select_next()
-                    elif data == -1:
-                        self.select_previous()
-
             if self.measuring:
                 current_time = ticks_ms()
-                if ticks_diff(current_time, self.start_time) > self.collection_time:
+                if ticks_diff(current_time, self.start_time) >= self.collection_time:
                     self.measuring = False
                     await self.send_to_kubios()
-                if self.rot.fifo.has_data():
-                    self.rot.get_last_input()
-
-            self.display()
-            await uasyncio.sleep_ms(50)
+                    self.invalidate()
+                self.rot.clear()
+
+            if not self.kubios_response:
+                # The start items change with the connection
+                self.selector_pos_y = min(self.selector_pos_y, len(self.start_items()) - 1)
+            self.render()
+            data = await self.wait_input()
+            if self.browsing is not None:
+                if data == 0:
+                    self.browsing = None
+                elif data:
+                    self.browsing = max(0, min(len(self.browse_keys) - 1, self.browsing + data))
+            elif data == 0:
+                if not self.measuring and not self.awaiting_response:
+                    if not self.kubios_response:
+                        # Handle start menu selection
+                        selected = self.start_items()[self.selector_pos_y]
+                        if selected == "Measure":
+                            await self.collect_and_send_data()
+                            self.invalidate()
+                        elif selected == "Retry":
+                            await self.send_to_kubios()
+                            self.invalidate()
+                        elif selected == "Results":
+                            self.browse_keys = self.pico_conn.kubios_cache.keys()
+                            self.browsing = 0
+                        else:
+                            return "MAIN"
+                    elif not self.show_results:
+                        self.show_results = True
+                        self.selector_pos_y = 0
+                    else:
+                        # Handle results menu selection
+                        selected = self.results_menu_items[self.selector_pos_y]
+                        if selected == "Measure Again":
+                            self.reset_state()
+                        else:
+                            self.reset_state()
+                            return "MAIN"
+                        
+            elif data and not self.measuring and not self.awaiting_response:
+                self.scroll(data)
 
     def display(self):
-        if self.wlan.isconnected():
-            self.oled.fill(0)
-            self.oled.fill_rect(0, 0, 48, 10, 1)
-            self.oled.text("KUBIOS", 0, 1, 0)
-            self.draw_wifi_status()
-            self.draw_signal_strength()
-
-            if not self.measuring and not self.awaiting_response:
-                if not self.pico_conn.latest_kubios_response:
-                    self.display_menu(self.start_menu_items)
-                elif self.show_results:
-                    self.display_menu(self.results_menu_items)
-                else:
-                    self.display_results()
-        else:
-            self.oled.fill(0)
-            self.error_state = True
-            self.oled.fill_rect(0, 0, 48, 10, 1)
-            self.oled.text("KUBIOS", 0, 1, 0)
-            self.draw_wifi_status()
-            self.draw_signal_strength()
-            self.oled.text("Connect to WIFI", 0, 20, 1)
-            self.oled.text("first", 0, 32, 1)
-            self.oled.text("Press to return", 0, 50, 1)
+        self.oled.fill(0)
+        self.oled.fill_rect(0, 0, 48, 10, 1)
+        self.oled.text("KUBIOS", 0, 1, 0)
+        self.draw_wifi_status()
+        self.draw_signal_strength()
+
+        if self.browsing is not None:
+            self.display_cached()
+        elif not self.measuring and not self.awaiting_response:
+            if not self.kubios_response:
+                if not self.wlan.isconnected():
+                    self.oled.text("WiFi offline", 0, 13, 1)
+                self.display_menu(self.start_items())
+            elif self.show_results:
+                self.display_menu(self.results_menu_items)
+            else:
+                self.display_results()
 
         self.oled.show()
 
     def display_menu(self, items=None):
-        menu_start_y = 25
+        # Four items only fit closer together
+        menu_start_y, spacing = (25, 15) if len(items) <= 3 else (16, 12)
         for i, item in enumerate(items):
-            self.oled.text(item, 4, menu_start_y + (i * 15), 1)
+            self.oled.text(item, 4, menu_start_y + (i * spacing), 1)
             if i == self.selector_pos_y:
                 text_width = len(item) * 8 + 8
-                self.oled.rect(0, menu_start_y + (i * 15) -
+                self.oled.rect(0, menu_start_y + (i * spacing) -
                                2, text_width, 12, 1)
 
     def display_results(self):
-        if not self.pico_conn.latest_kubios_response:
+        if not self.kubios_response:
             return
 
-        analysis = self.pico_conn.latest_kubios_response['data']['analysis']
+        analysis = self.kubios_response['data']['analysis']
         self.draw_scroll_indicators(6)
 
         for i in range(self.max_visible_items):
             param_idx = self.scroll_offset + i
             if param_idx >= len(self.parameters):
                 break
-
-            label, key, format_str = self.parameters[param_idx]
-            y = self.header_height + (i * self.line_height) + 6
-
-            self.oled.text(f"{label}:", 0, y, 1)
-            value = analysis.get(key)
-            if value is not None:
-                formatted_value = format_str.format(value)
-                x_pos = len(label) * 8 + 10
-                self.oled.text(formatted_value, x_pos, y, 1)
+            self.draw_parameter(analysis, param_idx, self.header_height + (i * self.line_height) + 6)
+
+    def display_cached(self):
+        """One past result from the cache per screen, all parameters at once. Turn for the next one."""
+        self.oled.text(f"{self.browsing + 1}/{len(self.browse_keys)}", 56, 1, 1)
+        entry = self.pico_conn.kubios_cache.entry(self.browse_keys[self.browsing])
+        if not entry:
+            self.oled.text("Result missing", 0, 25, 1)
+            return
+        analysis = entry['response']['data']['analysis']
+        for i in range(len(self.parameters)):
+            self.draw_parameter(analysis, i, 12 + i * 9)
+
+    def draw_parameter(self, analysis, index, y):
+        label, key, format_str = self.parameters[index]
+        self.oled.text(f"{label}:", 0, y, 1)
+        value = analysis.get(key)
+        if isinstance(value, (int, float)):
+            formatted_value = format_str.format(value)
+            x_pos = len(label) * 8 + 10
+            self.oled.text(formatted_value, x_pos, y, 1)
 
     async def collect_and_send_data(self):
         if not self.pico_conn.mqtt_client:
@@ -789,64 +851,45 @@ class KubiosMenu(BaseMenu):
         self.measuring = True
         self.start_time = ticks_ms()
         self.ppi_measurement_array.clear()
-        
+        self.HR.start(self.collection_time)
 
-        while ticks_diff(ticks_ms(), self.start_time) < self.collection_time:
-            current_time = ticks_ms()
-            elapsed = ticks_diff(current_time, self.start_time)
-            remaining = max(0, (self.collection_time - elapsed) // 1000)
-            self.HR.run(remaining)
-            await uasyncio.sleep_ms(100)
-
-        self.ppi_measurement_array = self.HR.get_ibi()
-        
-        self.HR.reset()
+        while True:
+            remaining = self.collection_time - ticks_diff(ticks_ms(), self.start_time)
+            if remaining <= 0:
+                break
+            ibi = await self.HR.beats.get(remaining)
+            if ibi is not None:
+                self.ppi_measurement_array.append(ibi)
+        # Beats from the detection task's last pass
+        ibi = self.HR.beats.get_nowait()
+        while ibi is not None:
+            self.ppi_measurement_array.append(ibi)
+            ibi = self.HR.beats.get_nowait()
+
+        self.HR.stop()
     
 
     async def send_to_kubios(self):
         if not self.ppi_measurement_array:
                 return
 
-        kubios_request = {
-            "id": 123,
-            "type": "RRI",
-            "data": self.ppi_measurement_array,
-            "analysis": {"type": "readiness"}
-        }
-
         try:
             self.awaiting_response = True
-            json_message = json.dumps(kubios_request)
-            await self.pico_conn.mqtt_publish(json_message, self.pico_conn.kubios_request_topic)
-
-            # Wait for Kubios response with timeout
-            timeout = 6
-            start_time = ticks_ms()
-
-            while self.awaiting_response:
-                if ticks_diff(ticks_ms(), start_time) > timeout * 1000:
-                    self.oled.fill(0)
-                    self.oled.text("No response from", 0, 20, 1)
-                    self.oled.text("Kubios!", 0, 32, 1)
-                    self.oled.show()
-                    self.awaiting_response = False
-                    await uasyncio.sleep(5)
-                    break
-
-                # Check for new messages
-                if self.pico_conn.mqtt_client:
-                    self.pico_conn.mqtt_client.check_msg()
-
-                    # If we got a response, pico_conn.latest_kubios_response will be updated
-                    if self.pico_conn.latest_kubios_response:
-                        self.awaiting_response = False
-                        break
-
-                # Clear rotary inputs during waiting
-                if self.rot.fifo.has_data():
-                    self.rot.get_last_input()
-
-                await uasyncio.sleep_ms(100)
+            request = self.pico_conn.submit_kubios(self.ppi_measurement_array)
+            if not request:
+                raise OSError("no MQTT session")
+
+            # The message pump resolves the request when the response with its id arrives
+            self.kubios_response = await request.result()
+            # Clear rotary inputs made while waiting
+            self.rot.clear()
+            if not self.kubios_response:
+                self.oled.fill(0)
+                self.oled.text("No response from", 0, 20, 1)
+                self.oled.text("Kubios!", 0, 32, 1)
+                self.oled.show()
+                self.awaiting_response = False
+                await uasyncio.sleep(5)
 
         except Exception as e:
             print(f"Error sending to Kubios: {e}")
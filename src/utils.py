@@ -1,13 +1,22 @@
 import time 
 import os
 import json
+import micropython
+import machine
+import uasyncio
 from machine import Pin
 from lib.fifo import Fifo
 
 
 class RotaryEncoder:
+    """Encoder events for the menus: a positive or negative step count for rotation, 0 for a click.
+    The hard IRQs only add to a step counter or queue a click and set a ThreadSafeFlag, so a menu can
+    await read() instead of polling. Steps turned between two reads come out as one event (+N/-N);
+    clicks are never merged or dropped, and steps turned before a click are delivered before it."""
     def __init__(self, rot_a, rot_b, rot_sw):
-        self.fifo = Fifo(10, typecode='i')
+        self.fifo = Fifo(16, typecode='i')  # clicks, and the steps that preceded each one
+        self.steps = 0
+        self.flag = uasyncio.ThreadSafeFlag()
         self.a = Pin(rot_a, mode=Pin.IN, pull=Pin.PULL_UP)  # Clockwise
         self.b = Pin(rot_b, mode=Pin.IN, pull=Pin.PULL_UP)  # Counter-clockwise
         self.sw = Pin(rot_sw, mode=Pin.IN, pull=Pin.PULL_UP)  # Switch
@@ -20,42 +29,157 @@ class RotaryEncoder:
 
     def rotary_handler(self, pin): 
         if self.b():
-            self.fifo.put(-1)
+            self.steps -= 1
         else:
-            self.fifo.put(1)
+            self.steps += 1
+        self.flag.set()
 
     def switch_handler(self, pin):  
         current_time = time.ticks_ms()
         if time.ticks_diff(current_time, self.last_sw_time) > self.debounce:
+            if self.steps:
+                self.fifo.put(self.steps)
+                self.steps = 0
             self.fifo.put(0)
             self.last_sw_time = current_time
+            self.flag.set()
 
-    def get_last_input(self):
-        """Get only the most recent input, clearing any old ones. Prevents fifo's buffer overflowing and makes the menu more responsive"""
-        last_input = None
-        while self.fifo.has_data():
-            last_input = self.fifo.get()
-        return last_input
+    def get(self):
+        """Next event without waiting, None if there is none"""
+        state = machine.disable_irq()
+        if self.fifo.has_data():
+            event = self.fifo.get()
+        elif self.steps:
+            event = self.steps
+            self.steps = 0
+        else:
+            event = None
+        machine.enable_irq(state)
+        return event
+
+    async def read(self, timeout_ms=None):
+        """Waits for the next event. Returns None if timeout_ms passes first."""
+        while True:
+            event = self.get()
+            if event is not None:
+                return event
+            if timeout_ms is None:
+                await self.flag.wait()
+                continue
+            try:
+                await uasyncio.wait_for_ms(self.flag.wait(), timeout_ms)
+            except uasyncio.TimeoutError:
+                return self.get()
+
+    def clear(self):
+        while self.get() is not None:
+            pass
+
+
+# SSD1306 commands used for partial updates
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+# Bytes of I2C traffic it costs to start another region (6 commands), used to decide when merging pages pays off
+REGION_COST = 18
 
 
+@micropython.native
+def changed_columns(buffer, screen, start, width):
+    """First and last column of the page starting at start that differ from the screen, or (-1, -1)"""
+    first = -1
+    for x in range(width):
+        if buffer[start + x] != screen[start + x]:
+            first = x
+            break
+    if first < 0:
+        return -1, -1
+    last = first
+    for x in range(width - 1, first, -1):
+        if buffer[start + x] != screen[start + x]:
+            last = x
+            break
+    return first, last
+
 
 class SSD1306Wrapper:
     """ 🎉This wrapper prevents crashing from timing issues with I2C and WLAN initialization that comes with the async execution.
-    Calls SSD1306 driver's show() method with retries. If the I2C write fails due to WiFi timing conflicts, it waits and retries up to 3 times."""
+    Calls SSD1306 driver's show() method with retries. If the I2C write fails due to WiFi timing conflicts, it waits and retries up to 3 times.
+    show() only sends what changed: the framebuffer is compared with a copy of what the display shows, page by page
+    (8 pixel rows), and each run of changed pages goes out as one column/page addressed window. A redraw that
+    produces the same picture costs no bus time."""
+    # Copy of the display RAM. There is one display, shared by every wrapper (menus and the HR plotter each have a driver)
+    screen = None
+
     def __init__(self, oled):
         self.oled = oled
+        # The driver blanked the display when it was created
+        SSD1306Wrapper.screen = bytearray(len(oled.buffer))
+        self.buffer_view = memoryview(oled.buffer)
+        self.col_offset = (128 - oled.width) // 2
 
     def __getattr__(self, name):
-        return getattr(self.oled, name)
+        # Cache the driver's attribute so later lookups skip __getattr__
+        value = getattr(self.oled, name)
+        setattr(self, name, value)
+        return value
+
+    def dirty_regions(self):
+        """Yields (x0, x1, first page, last page) windows covering every change"""
+        width = self.oled.width
+        buffer = self.oled.buffer
+        screen = SSD1306Wrapper.screen
+        run = None
+        for page in range(self.oled.pages):
+            x0, x1 = changed_columns(buffer, screen, page * width, width)
+            if x0 < 0:
+                if run:
+                    yield run
+                    run = None
+                continue
+            if run:
+                rx0, rx1, first, _ = run
+                pages = page - first
+                ux0 = min(rx0, x0)
+                ux1 = max(rx1, x1)
+                merged = (pages + 1) * (ux1 - ux0 + 1)
+                split = pages * (rx1 - rx0 + 1) + REGION_COST + x1 - x0 + 1
+                if merged <= split:
+                    run = (ux0, ux1, first, page)
+                    continue
+                yield run
+            run = (x0, x1, page, page)
+        if run:
+            yield run
+
+    def flush(self):
+        oled = self.oled
+        width = oled.width
+        screen = SSD1306Wrapper.screen
+        for x0, x1, first, last in self.dirty_regions():
+            oled.write_cmd(SET_COL_ADDR)
+            oled.write_cmd(x0 + self.col_offset)
+            oled.write_cmd(x1 + self.col_offset)
+            oled.write_cmd(SET_PAGE_ADDR)
+            oled.write_cmd(first)
+            oled.write_cmd(last)
+            # Pages of the window are not contiguous in the buffer, one write each; the display's column pointer
+            # wraps to x0 of the next page by itself
+            for page in range(first, last + 1):
+                start = page * width + x0
+                end = page * width + x1 + 1
+                oled.write_data(self.buffer_view[start:end])
+                screen[start:end] = self.buffer_view[start:end]
 
     def show(self):
+        # A failed write leaves its pages marked changed, the retry picks them up again
         for _ in range(3):
             try:
-                self.oled.show()
+                self.flush()
                 return
             except OSError:
                 time.sleep_ms(100)
-        self.oled.show()
+        self.flush()
+
 
 def load_config():
     with open('config.json', 'r') as f:
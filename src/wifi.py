@@ -1,13 +1,61 @@
 import os
 import mip
 import network
-from time import sleep, time
+import machine
+import binascii
+import random
+from time import sleep, time, ticks_ms, ticks_diff, ticks_add
 import uasyncio
 from lib.umqtt.simple import MQTTClient
+from src.components.outbox import Outbox
+from src.components.rri_codec import encode_rri, FORMAT as RRI_FORMAT
+from src.components.kubios_cache import KubiosCache, result_key
+from src.components.HR import Detect_peaks
 import json
 
+KEEPALIVE = 60  # s, the broker ends the session after 1.5x this without a packet from us
+PUMP_INTERVAL_MS = 50
+RECONNECT_MIN_MS = 1000
+RECONNECT_MAX_MS = 30000
+OUTBOX_BATCH = 8
+OUTBOX_BATCH_GAP_MS = 200  # between batches, so a long backlog doesn't flood the broker after a reconnect
+OUTBOX_RETRY_MIN_MS = 2000
+OUTBOX_RETRY_MAX_MS = 120000
+KUBIOS_TIMEOUT_MS = 6000
+KUBIOS_LATE_MS = 60000  # a response this long after the deadline still goes to the cache
+
 # TODO: REMOVE MQTT DEBUG PRINTS FROM FINAL VERSION
 
+class KubiosRequest:
+    """One Kubios request waiting for its response. resolve() is called by the message pump when a response
+    with this id arrives, result() waits for it until the deadline."""
+    def __init__(self, request_id, timeout_ms, key=None, analysis=None, beats=0):
+        self.id = request_id
+        self.deadline = ticks_add(ticks_ms(), timeout_ms)
+        self.key = key
+        self.analysis = analysis
+        self.beats = beats
+        self.response = None
+        self.event = uasyncio.Event()
+
+    def stale(self):
+        return ticks_diff(ticks_ms(), self.deadline) > KUBIOS_LATE_MS
+
+    def resolve(self, response):
+        self.response = response
+        self.event.set()
+
+    async def result(self):
+        """The response, None if none came by the deadline"""
+        remaining = ticks_diff(self.deadline, ticks_ms())
+        if self.response is None and remaining > 0:
+            try:
+                await uasyncio.wait_for_ms(self.event.wait(), remaining)
+            except uasyncio.TimeoutError:
+                pass
+        return self.response
+
+
 class PicoConnection:
     def __init__(self, ssid, password, broker_ip, broker_port, timeout, menus=[]):
         self.wlan = network.WLAN(network.STA_IF)
@@ -18,11 +66,29 @@ class PicoConnection:
         self.mqtt_topic = "hr-data"
         self.kubios_request_topic = "kubios-request"
         self.kubios_response_topic = "kubios-response"
+        # The gateway keeps a retained list of the compact request formats it translates here
+        self.kubios_formats_topic = "kubios-request/formats"
+        self.kubios_compact_topic = "kubios-request/" + RRI_FORMAT
+        self.rri_format = None
         self.menus = menus
         self.connected = False
         self.mqtt_client = None
+        self.client_id = b"pico-" + binascii.hexlify(machine.unique_id())
         self.timeout = timeout
-        self.latest_kubios_response = None
+        # Request id -> KubiosRequest. Responses come back on one shared topic, the id tells whose they are.
+        # Ids start at a random point so another device's or an earlier boot's responses don't match ours
+        self.kubios_pending = {}
+        self.kubios_next_id = random.getrandbits(30)
+        self.kubios_cache = KubiosCache()
+        # topic -> handler(msg), called by the message pump. Subscriptions are renewed on every reconnect
+        self.handlers = {}
+        self.last_ping = 0
+        self.subscribe(self.kubios_response_topic, self.kubios_response)
+        self.subscribe(self.kubios_formats_topic, self.kubios_formats)
+        # Messages that have to reach the broker eventually, kept on flash while offline
+        self.outbox = Outbox()
+        self.outbox_retry = OUTBOX_RETRY_MIN_MS
+        self.outbox_due = ticks_ms()
 
 
     async def connect(self):
@@ -46,9 +112,17 @@ class PicoConnection:
         while True:
             if self.wlan.isconnected():
                 # print(f"Connected to SSID: {self.ssid} Pico IP: {self.wlan.ifconfig()[0]}")
+                if not self.connected:
+                    # Link came back, send what queued up while it was down without waiting for the backoff
+                    self.outbox_retry = OUTBOX_RETRY_MIN_MS
+                    self.outbox_due = ticks_ms()
                 self.connected = True
                 self.menu_conn_status(True)      
-                await uasyncio.sleep(15)
+                # Opening the session blocks, so without one the outbox waits for the measurement to end
+                if (self.outbox.pending() and ticks_diff(ticks_ms(), self.outbox_due) >= 0
+                        and (self.mqtt_client or not Detect_peaks.running)):
+                    await self.flush_outbox()
+                await uasyncio.sleep(1 if self.outbox.pending() else 15)
                 continue
             else:
                 # print('Attempting to connect to WLAN...')
@@ -56,41 +130,192 @@ class PicoConnection:
                 self.menu_conn_status(False)
                 await self.connect()
 
+    async def flush_outbox(self):
+        """Sends the outbox in batches. A failed batch keeps its unsent messages and the next attempt
+        waits twice as long as the last one, up to OUTBOX_RETRY_MAX_MS."""
+        while self.outbox.pending():
+            if not await self.connect_mqtt():
+                break
+            sent = 0
+            position = None
+            batch = self.outbox.peek(OUTBOX_BATCH)
+            for topic, payload, end in batch:
+                if not self.mqtt_publish(payload, topic):
+                    break
+                sent += 1
+                position = end
+            self.outbox.commit(sent, position)
+            if sent < len(batch):
+                break
+            await uasyncio.sleep_ms(OUTBOX_BATCH_GAP_MS)
+        else:
+            self.outbox_retry = OUTBOX_RETRY_MIN_MS
+            return True
+        self.outbox_due = ticks_add(ticks_ms(), self.outbox_retry)
+        self.outbox_retry = min(self.outbox_retry * 2, OUTBOX_RETRY_MAX_MS)
+        return False
+
     def menu_conn_status(self, boolean):
         for menu in self.menus:
             menu.wifi_conn = boolean
 
-    def set_mqtt_callback(self, topic, msg):
-        """Set callback for MQTT messages"""
-        if self.mqtt_client and topic == self.kubios_response_topic.encode():
-            self.latest_kubios_response = json.loads(msg.decode())
+    def kubios_response(self, msg):
+        try:
+            response = json.loads(msg.decode())
+            request_id = response["id"]
+            if not isinstance(response["data"]["analysis"], dict):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            # A request that only gets a garbled answer times out
+            return
+        request = self.kubios_pending.pop(request_id, None)
+        if request:
+            request.resolve(response)
+            self.kubios_cache.put(request.key, response, request.analysis, request.beats)
+
+    def kubios_formats(self, msg):
+        self.rri_format = RRI_FORMAT if RRI_FORMAT in msg.decode().split(",") else None
+
+    def send_kubios_request(self, request_id, ibi, analysis="readiness"):
+        """Publishes an RRI analysis request, in the compact format when the gateway announced it translates
+        that, as JSON otherwise. Returns False when there is no session."""
+        if self.rri_format:
+            return self.mqtt_publish(encode_rri(request_id, ibi, analysis), self.kubios_compact_topic)
+        request = {"id": request_id, "type": "RRI", "data": ibi, "analysis": {"type": analysis}}
+        return self.mqtt_publish(json.dumps(request), self.kubios_request_topic)
+
+    def submit_kubios(self, ibi, analysis="readiness", timeout_ms=KUBIOS_TIMEOUT_MS):
+        """Sends an analysis request under a new id without waiting for the answer, so several can be in
+        flight. Returns its KubiosRequest, None when there is no session. A series analysed before is
+        answered from the cache, already resolved and without sending anything."""
+        key = result_key(ibi, analysis)
+        cached = self.kubios_cache.get(key)
+        if cached is not None:
+            request = KubiosRequest(None, 0, key)
+            request.resolve(cached)
+            return request
+        # Requests stay a while past their deadline, so a late response is cached for a retry
+        for request_id in [rid for rid, request in self.kubios_pending.items() if request.stale()]:
+            del self.kubios_pending[request_id]
+        request_id = self.kubios_next_id
+        self.kubios_next_id = (request_id + 1) & 0x3FFFFFFF
+        if not self.send_kubios_request(request_id, ibi, analysis):
+            return None
+        request = KubiosRequest(request_id, timeout_ms, key, analysis, len(ibi))
+        self.kubios_pending[request_id] = request
+        return request
+
+    async def kubios_analysis(self, ibi, analysis="readiness", timeout_ms=KUBIOS_TIMEOUT_MS):
+        """Sends a request and waits for its response. None if it could not be sent or timed out."""
+        request = self.submit_kubios(ibi, analysis, timeout_ms)
+        if not request:
+            return None
+        return await request.result()
+
+    def subscribe(self, topic, handler):
+        """handler(msg) gets every message on topic, for as long as the program runs"""
+        topic = topic.encode()
+        self.handlers[topic] = handler
+        if self.mqtt_client:
+            try:
+                self.mqtt_client.subscribe(topic)
+            except OSError:
+                self.drop_mqtt()
+
+    def dispatch(self, topic, msg):
+        handler = self.handlers.get(bytes(topic))
+        if handler:
+            handler(msg)
 
-    
     async def connect_mqtt(self):
+        """Opens the MQTT session unless it is up already. Returns True when connected."""
+        if self.mqtt_client:
+            return True
+        if not self.wlan.isconnected():
+            return False
         try:
-            self.mqtt_client = MQTTClient(
-                "pico", self.broker_ip, port=self.broker_port)
-            self.mqtt_client.set_callback(self.set_mqtt_callback)
-            self.mqtt_client.connect(clean_session=True)
-            # Subscribe to Kubios response topic
-            self.mqtt_client.subscribe(self.kubios_response_topic.encode())
-            print(f"Connected to MQTT broker. Subscribed to topic: {self.kubios_response_topic}")
-
+            client = MQTTClient(self.client_id, self.broker_ip, port=self.broker_port, keepalive=KEEPALIVE)
+            client.set_callback(self.dispatch)
+            client.connect(clean_session=True)
+            # Known again once the retained format list arrives, if the gateway still has one
+            self.rri_format = None
+            for topic in self.handlers:
+                client.subscribe(topic)
+            self.mqtt_client = client
+            self.last_ping = ticks_ms()
+            print(f"Connected to MQTT broker. Subscribed to: {list(self.handlers)}")
+            return True
         except Exception as e:
             print(f"Failed to connect to MQTT: {e}")
-            self.mqtt_client = None
+            return False
+
+    def drop_mqtt(self):
+        client = self.mqtt_client
+        self.mqtt_client = None
+        if not client:
+            return
+        try:
+            client.disconnect()
+        except OSError:
+            # The connection is gone already, just release the socket
+            sock = getattr(client, "sock", None)
+            if sock:
+                sock.close()
 
-    async def mqtt_publish(self, message, topic=None):
-        """Publish message to MQTT broker. If topic not specified, uses default topic."""
+    async def mqtt_pump(self):
+        """Background task owning the MQTT session: connects (backing off while the broker can't be reached),
+        delivers incoming messages to the handlers, pings within the keepalive and reconnects after errors.
+        MQTTClient.connect() blocks until the broker answers or the socket times out, so there are no
+        connect attempts while a measurement is running."""
+        retry = RECONNECT_MIN_MS
+        while True:
+            if not self.mqtt_client and Detect_peaks.running:
+                await uasyncio.sleep_ms(RECONNECT_MIN_MS)
+                continue
+            if not self.mqtt_client:
+                if await self.connect_mqtt():
+                    retry = RECONNECT_MIN_MS
+                else:
+                    await uasyncio.sleep_ms(retry)
+                    if self.wlan.isconnected():
+                        retry = min(retry * 2, RECONNECT_MAX_MS)
+                    continue
+            try:
+                if not self.wlan.isconnected():
+                    raise OSError("WLAN down")
+                self.mqtt_client.check_msg()
+                if ticks_diff(ticks_ms(), self.last_ping) > KEEPALIVE * 1000 // 2:
+                    self.mqtt_client.ping()
+                    self.last_ping = ticks_ms()
+            except OSError:
+                self.drop_mqtt()
+            await uasyncio.sleep_ms(PUMP_INTERVAL_MS)
+
+    def publish_durable(self, message, topic=None):
+        """Like mqtt_publish, but a message that can't go out now is kept in the outbox and sent later.
+        Returns True if it was sent right away."""
+        if isinstance(message, dict):
+            message = json.dumps(message)
+        topic = topic or self.mqtt_topic
+        # Anything already waiting goes first, to keep the order
+        if not self.outbox.pending() and self.mqtt_publish(message, topic):
+            return True
+        self.outbox.put(topic, message)
+        return False
+
+    def mqtt_publish(self, message, topic=None):
+        """Publish message (str, bytes or a dict sent as JSON) on the open session, without waiting.
+        If topic not specified, uses default topic. Returns False when there is no session or the send failed."""
         if not self.mqtt_client:
             return False
-
+        if isinstance(message, dict):
+            message = json.dumps(message)
         try:
             publish_topic = topic or self.mqtt_topic
             self.mqtt_client.publish(publish_topic.encode(), message)
-            await uasyncio.sleep_ms(500)
             return True
-        except Exception as e:
+        except OSError as e:
             print(f"Failed to send MQTT message: {e}")
+            self.drop_mqtt()
             return False
 